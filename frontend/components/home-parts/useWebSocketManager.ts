@@ -207,19 +207,22 @@ export const useWebSocketManager = ({
     wsInstance.onmessage = (event) => {
       console.log("WEBSOCKET_DEBUG: Received message:", event.data);
       try {
-        const data = JSON.parse(event.data as string);
-        const { type, content } = data;
-
-        switch (type) {
-          case "connection_established":
-          case "workspace_info":
-            console.log("WEBSOCKET_DEBUG: Server ready signal received");
-            setIsSocketReady(true);
-            break;
-          // Other cases will be handled by the generic event receiver below
+        const parsed = JSON.parse(event.data as string);
+        // The server coalesces bursts of agent events into one frame holding an array
+        const events = Array.isArray(parsed) ? parsed : [parsed];
+
+        for (const data of events) {
+          switch (data.type) {
+            case "connection_established":
+            case "workspace_info":
+              console.log("WEBSOCKET_DEBUG: Server ready signal received");
+              setIsSocketReady(true);
+              break;
+            // Other cases will be handled by the generic event receiver below
+          }
+
+          onEventReceivedRef.current({ ...data, id: data.id || uuidv4() });
         }
-        
-        onEventReceivedRef.current({ ...data, id: data.id || uuidv4() });
 
       } catch (error) {
         console.error("WEBSOCKET_DEBUG: Error parsing WebSocket data:", error);
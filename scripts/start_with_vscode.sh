@@ -22,4 +22,4 @@ sleep 2
 # Start the main application
 echo "Starting main application..."
 cd /opt/render/project/src
-exec python -m uvicorn ws_server:app --host 0.0.0.0 --port ${PORT:-8000} 
\ No newline at end of file
+exec python -m uvicorn ws_server:app --host 0.0.0.0 --port ${PORT:-8000} --ws-per-message-deflate false 
\ No newline at end of file
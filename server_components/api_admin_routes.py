@@ -2,6 +2,7 @@
 Handles administrative API routes for server management, Pro key generation, and statistics.
 """
 import os
+import hmac
 import logging
 import shutil
 import tempfile
@@ -12,12 +13,11 @@ from pathlib import Path
 from fastapi import APIRouter, Depends, Header, HTTPException, Query, Response
 from fastapi.responses import JSONResponse, FileResponse
 
-from ii_agent.db.manager import DatabaseManager
 from ii_agent.db.models import Event # Assuming Event model might be used in stats or cleanup
 from ii_agent.utils.pro_utils import generate_pro_key as util_generate_pro_key, validate_pro_key
 from ii_agent.utils.constants import PERSISTENT_WORKSPACE_ROOT, PERSISTENT_DATA_ROOT
 
-from .common import create_cors_response # Relative import
+from .common import create_cors_response, get_db_manager # Relative import
 
 # Attempt to import psutil for system stats, but allow it to be optional
 try:
@@ -32,31 +32,32 @@ router = APIRouter()
 
 # Admin Key Management
 ADMIN_KEY_ENV = os.getenv("ADMIN_KEY")
+# Encoded once so every request only pays for the constant-time compare
+_ADMIN_KEY = ADMIN_KEY_ENV.encode() if ADMIN_KEY_ENV else None
 
-async def verify_admin_key(authorization: str = Header(None), admin_key_query: str = Query(None, alias="admin_key")):
+def verify_admin_key(authorization: str = Header(None), admin_key_query: str = Query(None, alias="admin_key")):
     """
     Verify admin authentication via Bearer token or query parameter.
     Query parameter is checked first, then Bearer token.
+    Declared sync on purpose: FastAPI runs sync dependencies in its threadpool,
+    and this check never awaits anything.
     """
-    if not ADMIN_KEY_ENV:
+    if _ADMIN_KEY is None:
         logger.error("ADMIN_KEY environment variable is not set. Admin endpoints are disabled.")
         raise HTTPException(status_code=503, detail="Admin functionality not configured.")
 
-    provided_key = admin_key_query # Check query param first
-
-    if not provided_key and authorization: # If not in query, check header
-        scheme, _, token = authorization.partition(" ")
-        if scheme.lower() == "bearer":
-            provided_key = token
-        else: # If header is present but not Bearer, it might be the key directly
-            provided_key = authorization
-
+    if admin_key_query:
+        provided_key = admin_key_query # Check query param first
+    elif authorization is not None and authorization[:7].lower() == "bearer ":
+        provided_key = authorization[7:]
+    else: # If header is present but not Bearer, it might be the key directly
+        provided_key = authorization
 
     if not provided_key:
         logger.warning("Admin access attempt without key.")
         raise HTTPException(status_code=401, detail="Not authenticated: Admin key required.")
     
-    if provided_key != ADMIN_KEY_ENV:
+    if not hmac.compare_digest(provided_key.encode(), _ADMIN_KEY):
         logger.warning("Admin access attempt with invalid key.")
         raise HTTPException(status_code=401, detail="Invalid authentication credentials.")
     
@@ -121,7 +122,7 @@ async def get_pro_usage_endpoint(pro_key: str):
             logger.warning(f"Pro Usage API: Invalid Pro key format or key not found: {pro_key}")
             return create_cors_response({"error": "Invalid Pro key"}, 400)
         
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
         usage_stats = db_manager.get_pro_usage(pro_key) # Assuming this method exists
         
         logger.info(f"Pro Usage API: Retrieved usage for key {pro_key[:4]}****: {usage_stats}")
@@ -160,7 +161,7 @@ async def get_admin_stats_endpoint():
         stats["system"] = {"status": "psutil not available, system stats limited"}
 
     try:
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
         db_path_actual = db_manager.db_path # This should be the actual path from the manager
         
         db_size_bytes = 0
@@ -276,7 +277,7 @@ async def cleanup_data_endpoint():
 
     # Database Cleanup (Events table)
     try:
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
         with db_manager.get_session() as session:
             # Delete oldest events
             oldest_events_query = session.query(Event).order_by(Event.timestamp.asc()).limit(MAX_DB_ROWS_TO_DELETE)
@@ -317,7 +318,7 @@ async def download_data_endpoint():
     try:
         with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zf:
             # Database
-            db_manager = DatabaseManager()
+            db_manager = get_db_manager()
             actual_db_path = Path(db_manager.db_path)
             if actual_db_path.exists() and actual_db_path.is_file():
                 zf.write(actual_db_path, arcname=actual_db_path.name)
@@ -3,20 +3,66 @@ Handles API routes for file browsing, content retrieval, and downloads within wo
 """
 import logging
 import base64
+import codecs
+import hashlib
+import io
+import json
 from pathlib import Path
 import os
-import tempfile
+import stat
 import zipfile
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse, FileResponse
+import zlib
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import quote
+from typing import AsyncIterator, Deque, Iterator, List, Optional, Tuple, Union
+
+import aiofiles
+import anyio
+import orjson
+from cachetools import TTLCache
+from fastapi import APIRouter, Request
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 
 from .common import create_cors_response # Relative import
 from .config import app_config # Relative import
 
+# pybase64 (SIMD base64) is optional; fall back to the stdlib encoder without it
+try:
+    import pybase64
+    b64encode_to_str = pybase64.b64encode_as_string
+except ImportError:
+    pybase64 = None
+    def b64encode_to_str(data: bytes) -> str:
+        return base64.b64encode(data).decode("ascii")
+
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-def build_file_tree_recursive(target_path: Path, workspace_path: Path, max_depth: int = 10, current_depth: int = 0) -> list:
+# (serialized listing, ETag) keyed by (workspace_id, target path, directory mtime_ns, sort flag)
+list_files_cache: TTLCache = TTLCache(maxsize=1024, ttl=2.0)
+
+# Files above this size are streamed back instead of being read into memory at once
+FILE_CONTENT_STREAM_THRESHOLD = 8 * 1024 * 1024
+FILE_CONTENT_CHUNK_SIZE = 64 * 1024
+# When set (e.g. "/internal-workspace"), single-file downloads are handed to the fronting
+# nginx via X-Accel-Redirect; that location must map onto the workspace root and be internal.
+FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX = os.getenv("FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX")
+ZIP_STREAM_CHUNK_SIZE = 64 * 1024
+# Formats that are already compressed; DEFLATE only burns CPU on them
+INCOMPRESSIBLE_EXTENSIONS = frozenset({
+    '.png', '.jpg', '.jpeg', '.gif', '.webp', '.mp3', '.mp4', '.mov',
+    '.zip', '.gz', '.xz', '.bz2', '.7z', '.pdf',
+})
+ZIP_DEFLATE_LEVEL = 6
+# Files up to this size are read whole and compressed on zip_compress_pool
+ZIP_PARALLEL_MAX_FILE_SIZE = 8 * 1024 * 1024
+ZIP_PARALLEL_WORKERS = os.cpu_count() or 4
+# Entries queued ahead of the writer; caps memory at roughly window * max file size
+ZIP_PARALLEL_WINDOW = ZIP_PARALLEL_WORKERS * 2
+zip_compress_pool = ThreadPoolExecutor(max_workers=ZIP_PARALLEL_WORKERS, thread_name_prefix="zip-deflate")
+
+def build_file_tree_recursive(target_path: Union[str, Path], workspace_path: Union[str, Path], max_depth: int = 10, current_depth: int = 0, sort: bool = True) -> list:
     """
     Recursively build file tree structure with children.
     
@@ -25,6 +71,7 @@ def build_file_tree_recursive(target_path: Path, workspace_path: Path, max_depth
         workspace_path: The root workspace path for security checks and relative path calculation
         max_depth: Maximum recursion depth to prevent infinite loops
         current_depth: Current recursion depth
+        sort: Order folders first, then by case-insensitive name; False keeps directory order
     
     Returns:
         List of file/folder dictionaries with children populated for folders
@@ -33,38 +80,53 @@ def build_file_tree_recursive(target_path: Path, workspace_path: Path, max_depth
         logger.warning(f"[FILE_BROWSER] Max depth {max_depth} reached at {target_path}")
         return []
     
-    files = []
+    # entry.path always starts with the workspace path, so display paths are a plain slice
+    workspace_prefix_len = len(os.fspath(workspace_path)) + len(os.sep)
     try:
-        for item in sorted(list(target_path.iterdir()), key=lambda p: (p.is_file(), p.name.lower())):
-            if item.name.startswith('.'): # Skip hidden files/folders
-                logger.debug(f"[FILE_BROWSER] Skipping hidden item: {item.name}")
-                continue
-            
+        # DirEntry caches the file type from the directory read, so classifying
+        # entries below costs no extra stat() calls.
+        with os.scandir(target_path) as it:
+            # Sort keys are computed once per entry; the name breaks casefold ties so
+            # tuple comparison never falls through to the DirEntry itself.
+            entries = [
+                (not entry.is_dir(follow_symlinks=False), entry.name.casefold(), entry.name, entry)
+                for entry in it if not entry.name.startswith('.') # Skip hidden files/folders
+            ]
+        if sort:
+            entries.sort()
+
+        # Pre-sized and filled by index; each entry is a single dict literal
+        files = [None] * len(entries)
+        for i, (is_file, _, name, entry) in enumerate(entries):
             # Construct path relative to the workspace_id directory for client-side display
-            display_path = str(item.relative_to(workspace_path))
+            display_path = entry.path[workspace_prefix_len:]
+
+            if is_file:
+                dot = name.rfind('.')
+                files[i] = {
+                    "name": name,
+                    "type": "file",
+                    "path": display_path, # Use relative path for client
+                    "language": name[dot + 1:].lower() if 0 < dot < len(name) - 1 else "plaintext",
+                }
+                continue
 
-            file_info = {
-                "name": item.name,
-                "type": "folder" if item.is_dir() else "file",
+            # Recursively get children for folders
+            try:
+                children = build_file_tree_recursive(entry.path, workspace_path, max_depth, current_depth + 1, sort)
+            except PermissionError:
+                logger.warning(f"[FILE_BROWSER] Permission denied accessing children of: {entry.path}")
+                children = []
+            except Exception as e:
+                logger.error(f"[FILE_BROWSER] Error accessing children of {entry.path}: {e}")
+                children = []
+            files[i] = {
+                "name": name,
+                "type": "folder",
                 "path": display_path, # Use relative path for client
+                "children": children,
             }
             
-            if item.is_file():
-                file_info["language"] = item.suffix[1:].lower() if item.suffix else "plaintext"
-            elif item.is_dir():
-                # Recursively get children for folders
-                try:
-                    children = build_file_tree_recursive(item, workspace_path, max_depth, current_depth + 1)
-                    file_info["children"] = children
-                except PermissionError:
-                    logger.warning(f"[FILE_BROWSER] Permission denied accessing children of: {item}")
-                    file_info["children"] = []
-                except Exception as e:
-                    logger.error(f"[FILE_BROWSER] Error accessing children of {item}: {e}")
-                    file_info["children"] = []
-
-            files.append(file_info)
-            
     except PermissionError:
         logger.error(f"[FILE_BROWSER] Permission denied accessing: {target_path}")
         raise
@@ -74,6 +136,249 @@ def build_file_tree_recursive(target_path: Path, workspace_path: Path, max_depth
     
     return files
 
+def is_utf8_file(file_path: Path) -> bool:
+    """True if the whole file is valid UTF-8; decoded chunk by chunk and the text discarded."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    try:
+        with open(file_path, "rb") as f:
+            while chunk := f.read(FILE_CONTENT_CHUNK_SIZE):
+                decoder.decode(chunk)
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        return False
+    return True
+
+async def stream_file_content(target_file: Path) -> AsyncIterator[bytes]:
+    """
+    Stream a file as the same {"content", "encoding"} JSON document returned for small files.
+
+    As for small files, the encoding is utf-8 only if the whole file decodes as UTF-8, so
+    the file is scanned once on a worker thread before anything is sent. Text is then
+    streamed JSON-escaped, otherwise every chunk is base64-encoded on 3-byte boundaries so
+    the concatenated output is identical to encoding the whole file at once.
+    """
+    is_text = await anyio.to_thread.run_sync(is_utf8_file, target_file)
+    async with aiofiles.open(target_file, "rb") as f:
+        chunk = await f.read(FILE_CONTENT_CHUNK_SIZE)
+        # Strict: a file rewritten since the scan ends the response instead of sending U+FFFD
+        decoder = codecs.getincrementaldecoder("utf-8")()
+
+        if is_text:
+            yield b'{"encoding": "utf-8", "content": "'
+            while chunk:
+                text_part = decoder.decode(chunk)
+                if text_part:
+                    yield json.dumps(text_part)[1:-1].encode("utf-8")
+                chunk = await f.read(FILE_CONTENT_CHUNK_SIZE)
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield json.dumps(tail)[1:-1].encode("utf-8")
+        else:
+            yield b'{"encoding": "base64", "content": "'
+            leftover = b""
+            while chunk:
+                buffer = leftover + chunk
+                cut = len(buffer) - len(buffer) % 3
+                leftover = buffer[cut:]
+                yield base64.b64encode(buffer[:cut])
+                chunk = await f.read(FILE_CONTENT_CHUNK_SIZE)
+            if leftover:
+                yield base64.b64encode(leftover)
+        yield b'"}'
+
+class ZipStreamBuffer(io.RawIOBase):
+    """Unseekable write-only sink; zipfile falls back to data descriptors when writing to it."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def iter_zip_entries(directory: str, base_len: int) -> Iterator[Tuple[str, str]]:
+    """Yield (file path, archive name) for every non-hidden file below directory.
+
+    base_len is the length of the archive root path plus its separator. Like os.walk,
+    symlinked directories are neither descended into nor archived.
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.startswith('.'): # Skip hidden files/folders
+                continue
+            if entry.is_dir():
+                if not entry.is_symlink():
+                    yield from iter_zip_entries(entry.path, base_len)
+                continue
+            yield entry.path, entry.path[base_len:]
+
+def deflate_file(file_path: str) -> Tuple[bytes, int, int]:
+    """Read and raw-DEFLATE a whole file. Returns (compressed bytes, CRC-32, uncompressed size)."""
+    with open(file_path, "rb") as f:
+        data = f.read()
+    # Same raw stream (wbits=-15) that zipfile writes for ZIP_DEFLATED entries
+    compressor = zlib.compressobj(ZIP_DEFLATE_LEVEL, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    return compressed, zlib.crc32(data), len(data)
+
+class StreamingZipFile(zipfile.ZipFile):
+    """
+    ZipFile that can also append entries whose DEFLATE stream was produced elsewhere
+    (deflate_file on zip_compress_pool).
+
+    zipfile has no public API for that, so write_precompressed maintains the same private
+    state zipfile's own entry writer does (fp, filelist/NameToInfo, start_dir, _didModify)
+    and goes through its _writing guard and _writecheck first. Kept to this one class;
+    tests/test_api_file_routes.py round-trips archives written with it.
+    """
+    def write_precompressed(self, zinfo: zipfile.ZipInfo, compressed: bytes, crc: int, file_size: int) -> None:
+        if self._writing:
+            raise ValueError("Can't write to the ZIP file while there is another write handle open on it.")
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        zinfo.flag_bits = 0 # Sizes and CRC are known up front, so no data descriptor is needed
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = len(compressed)
+        self._writecheck(zinfo) # Mode, open file, compression and ZIP64 limits
+        with self._lock:
+            zinfo.header_offset = self.fp.tell()
+            self.fp.write(zinfo.FileHeader())
+            self.fp.write(compressed)
+            # Register the entry the same way zipfile does when one of its entries is
+            # closed, so close() emits it in the central directory
+            self.filelist.append(zinfo)
+            self.NameToInfo[zinfo.filename] = zinfo
+            self.start_dir = self.fp.tell()
+            self._didModify = True
+
+def write_zip_entry(zipf: StreamingZipFile, sink: ZipStreamBuffer, file_path: str, zinfo: zipfile.ZipInfo, future: Optional[Future]) -> Iterator[bytes]:
+    """Write one entry, either from a pool-compressed result or by streaming the file through zipfile."""
+    if future is not None:
+        compressed, crc, file_size = future.result()
+        zipf.write_precompressed(zinfo, compressed, crc, file_size)
+        yield sink.drain()
+        return
+
+    if os.path.splitext(file_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+    with open(file_path, "rb") as src, zipf.open(zinfo, "w") as dst:
+        while True:
+            chunk = src.read(ZIP_STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            dst.write(chunk)
+            data = sink.drain()
+            if data:
+                yield data
+
+def iter_zip_stream(target_folder: Path) -> Iterator[bytes]:
+    """Yield a zip archive of target_folder (hidden entries skipped) chunk by chunk.
+
+    Text-like files are DEFLATEd; already-compressed formats are stored as-is.
+    Compressible files up to ZIP_PARALLEL_MAX_FILE_SIZE are compressed ahead of time
+    on a thread pool (zlib releases the GIL), while entries are still written in
+    walk order; larger files are streamed through zipfile to keep memory bounded.
+    """
+    sink = ZipStreamBuffer()
+    file_count = 0
+    pending: Deque[Tuple[str, zipfile.ZipInfo, Optional[Future]]] = deque()
+    target_folder_str = os.fspath(target_folder)
+    try:
+        with StreamingZipFile(sink, 'w', zipfile.ZIP_DEFLATED) as zipf:
+            for file_full_path, arcname in iter_zip_entries(target_folder_str, len(target_folder_str) + len(os.sep)):
+                zinfo = zipfile.ZipInfo.from_file(file_full_path, arcname)
+                future = None
+                if (os.path.splitext(file_full_path)[1].lower() not in INCOMPRESSIBLE_EXTENSIONS
+                        and zinfo.file_size <= ZIP_PARALLEL_MAX_FILE_SIZE):
+                    future = zip_compress_pool.submit(deflate_file, file_full_path)
+                pending.append((file_full_path, zinfo, future))
+
+                # Bound the number of compressed entries held in memory
+                while len(pending) > ZIP_PARALLEL_WINDOW:
+                    yield from write_zip_entry(zipf, sink, *pending.popleft())
+                    file_count += 1
+
+            while pending:
+                yield from write_zip_entry(zipf, sink, *pending.popleft())
+                file_count += 1
+        # Closing the archive writes the central directory
+        yield sink.drain()
+        logger.info(f"[ZIP_DOWNLOAD] Finished streaming zip for {target_folder} ({file_count} files)")
+    except Exception as e_zip:
+        # Headers are already sent at this point, so the client sees a truncated archive
+        logger.error(f"[ZIP_DOWNLOAD] Error during zip streaming for {target_folder}: {e_zip}", exc_info=True)
+        raise
+    finally:
+        for _, _, future in pending:
+            if future is not None:
+                future.cancel()
+
+def file_etag(file_stat: os.stat_result) -> str:
+    """Weak ETag derived from size and mtime; changes whenever the file is rewritten."""
+    return f'W/"{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """True if the request's If-None-Match covers etag (weak comparison, as RFC 9110 requires for it)."""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    opaque_tag = etag.removeprefix("W/")
+    return any(tag.strip().removeprefix("W/") == opaque_tag for tag in if_none_match.split(","))
+
+def not_modified_response(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag})
+
+def is_within(path: str, root: str) -> bool:
+    """True if normalized path is root itself or below it (so /ws2 is not inside /ws)."""
+    return path == root or path.startswith(root + os.sep)
+
+def resolve_inside(workspace_path: Path, relative_path: str) -> Optional[Path]:
+    """
+    Join relative_path onto workspace_path and return the result if it stays inside
+    the workspace, otherwise None.
+
+    The common case is decided lexically (normpath + prefix check) plus one lstat per
+    appended component. Symlinks are looked for on the joined path before anything is
+    resolved; only when one is found is the real target resolved and checked, since
+    that is the only way the lexical answer can be wrong.
+    """
+    if "\0" in relative_path:
+        return None # os calls would raise ValueError; never a legitimate workspace path
+    workspace_str = os.fspath(workspace_path)
+    candidate = os.path.normpath(os.path.join(workspace_str, relative_path))
+    if not is_within(candidate, workspace_str):
+        return None
+
+    current = workspace_str
+    for part in candidate[len(workspace_str) + len(os.sep):].split(os.sep):
+        if not part:
+            continue
+        current = os.path.join(current, part)
+        try:
+            is_symlink = stat.S_ISLNK(os.lstat(current).st_mode)
+        except (FileNotFoundError, NotADirectoryError):
+            break # Nothing below a missing component can be a symlink; callers report 404
+        if is_symlink:
+            resolved_str = os.path.realpath(candidate)
+            if not is_within(resolved_str, os.path.realpath(workspace_str)):
+                return None
+            return Path(resolved_str)
+
+    return Path(candidate)
+
 @router.post("/api/files/list")
 async def list_files_endpoint(request: Request):
     """API endpoint for listing files in a workspace directory with recursive children."""
@@ -81,6 +386,7 @@ async def list_files_endpoint(request: Request):
         data = await request.json()
         workspace_id = data.get("workspace_id")
         path_str = data.get("path", "") # Renamed to path_str to avoid conflict with Path module
+        sort_entries = bool(data.get("sort", True)) # Clients that sort themselves can skip the server-side sort
 
         logger.info(f"[FILE_BROWSER] List files - workspace_id: {workspace_id}, path: {path_str}")
 
@@ -93,8 +399,11 @@ async def list_files_endpoint(request: Request):
             logger.error("[FILE_BROWSER] Workspace root path not configured.")
             return create_cors_response({"error": "Server configuration error: Workspace root missing."}, 500)
 
-        workspace_root_path = Path(current_args.workspace).resolve()
-        workspace_path = workspace_root_path / workspace_id
+        workspace_root_path = app_config.get_workspace_root()
+        workspace_path = resolve_inside(workspace_root_path, workspace_id)
+        if workspace_path is None:
+            logger.error(f"[FILE_BROWSER] Access denied: workspace_id {workspace_id} is outside workspace root")
+            return create_cors_response({"error": "Access denied to workspace"}, 403)
         logger.info(f"[FILE_BROWSER] Workspace root: {workspace_root_path}, session workspace: {workspace_path}")
         
         if not workspace_path.exists() or not workspace_path.is_dir():
@@ -111,13 +420,12 @@ async def list_files_endpoint(request: Request):
             if ".." in relative_path_str.split(os.path.sep):
                 logger.error(f"[FILE_BROWSER] Invalid path (directory traversal attempt): {path_str}")
                 return create_cors_response({"error": "Invalid path"}, 400)
-            target_path = (workspace_path / relative_path_str).resolve()
-            logger.info(f"[FILE_BROWSER] Relative path: {relative_path_str}, target: {target_path}")
-
             # Security check: ensure target_path is still within workspace_path
-            if not str(target_path).startswith(str(workspace_path)):
-                logger.error(f"[FILE_BROWSER] Access denied: {target_path} is outside workspace {workspace_path}")
+            target_path = resolve_inside(workspace_path, relative_path_str)
+            if target_path is None:
+                logger.error(f"[FILE_BROWSER] Access denied: {relative_path_str} is outside workspace {workspace_path}")
                 return create_cors_response({"error": "Access denied to path"}, 403)
+            logger.info(f"[FILE_BROWSER] Relative path: {relative_path_str}, target: {target_path}")
 
         if not target_path.exists() or not target_path.is_dir():
             logger.error(f"[FILE_BROWSER] Target path not found or not a directory: {target_path}")
@@ -127,15 +435,31 @@ async def list_files_endpoint(request: Request):
 
         # Use the recursive function to build the complete file tree
         try:
-            files = build_file_tree_recursive(target_path, workspace_path)
-            logger.info(f"[FILE_BROWSER] Returning {len(files)} visible items from {target_path} with recursive children")
+            # Repeat listings of an unchanged folder within the TTL are served from memory.
+            # The directory mtime only tracks direct children, so the short TTL bounds
+            # how long a change deeper in the tree can go unnoticed.
+            cache_key = (workspace_id, os.fspath(target_path), target_path.stat().st_mtime_ns, sort_entries)
+            cached = list_files_cache.get(cache_key)
+            if cached is None:
+                files = build_file_tree_recursive(target_path, workspace_path, sort=sort_entries)
+                # The serialized body is cached, so hits skip the tree build and the JSON encode
+                listing_body = orjson.dumps({"files": files})
+                # Content hash, so the ETag also changes for edits deeper than the top-level mtime sees
+                listing_etag = f'W/"{hashlib.blake2b(listing_body, digest_size=16).hexdigest()}"'
+                list_files_cache[cache_key] = (listing_body, listing_etag)
+                logger.info(f"[FILE_BROWSER] Returning {len(files)} visible items from {target_path} with recursive children")
+            else:
+                listing_body, listing_etag = cached
+                logger.info(f"[FILE_BROWSER] Returning cached listing of {target_path} ({len(listing_body)} bytes)")
+            if etag_matches(request, listing_etag):
+                return not_modified_response(listing_etag)
         except PermissionError:
             logger.error(f"[FILE_BROWSER] Permission denied accessing: {target_path}")
             return create_cors_response(
                 {"error": f"Permission denied accessing: {path_str}"}, 403
             )
 
-        return create_cors_response({"files": files})
+        return Response(listing_body, media_type="application/json", headers={"ETag": listing_etag})
 
     except Exception as e:
         logger.error(f"[FILE_BROWSER] Error listing files: {str(e)}", exc_info=True)
@@ -166,8 +490,10 @@ async def get_file_content_endpoint(request: Request):
             logger.error("[FILE_CONTENT] Workspace root path not configured.")
             return create_cors_response({"error": "Server configuration error: Workspace root missing."}, 500)
 
-        workspace_root_path = Path(current_args.workspace).resolve()
-        workspace_path = workspace_root_path / workspace_id
+        workspace_path = resolve_inside(app_config.get_workspace_root(), workspace_id)
+        if workspace_path is None:
+            logger.error(f"[FILE_CONTENT] Access denied: workspace_id {workspace_id} is outside workspace root")
+            return create_cors_response({"error": "Access denied to workspace"}, 403)
 
         if not workspace_path.exists() or not workspace_path.is_dir():
             logger.error(f"[FILE_CONTENT] Workspace not found: {workspace_path}")
@@ -177,31 +503,49 @@ async def get_file_content_endpoint(request: Request):
 
         # Construct the full path to the file, ensuring it's within the workspace
         # file_path_str is expected to be relative to the workspace_id directory
-        target_file = (workspace_path / file_path_str).resolve()
-
         # Security check: ensure target_file is within workspace_path
-        if not str(target_file).startswith(str(workspace_path)):
-            logger.error(f"[FILE_CONTENT] Access denied: {target_file} is outside workspace {workspace_path}")
+        target_file = resolve_inside(workspace_path, file_path_str)
+        if target_file is None:
+            logger.error(f"[FILE_CONTENT] Access denied: {file_path_str} is outside workspace {workspace_path}")
             return create_cors_response({"error": "Access denied to file"}, 403)
 
-        if not target_file.exists() or not target_file.is_file():
+        try:
+            file_stat = target_file.stat()
+        except FileNotFoundError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
             logger.error(f"[FILE_CONTENT] File not found or not a file: {target_file}")
             return create_cors_response(
                 {"error": f"File not found: {file_path_str}"}, 404
             )
 
+        etag = file_etag(file_stat)
+        if etag_matches(request, etag):
+            return not_modified_response(etag) # Client copy is current; skip the read and encode
+
         try:
-            with open(target_file, "r", encoding='utf-8') as f:
-                content = f.read()
-            logger.info(f"[FILE_CONTENT] Read text file: {target_file}, length: {len(content)}")
-            return create_cors_response({"content": content, "encoding": "utf-8"})
-        except UnicodeDecodeError:
-            logger.info(f"[FILE_CONTENT] File {target_file} is not UTF-8 text, attempting binary read.")
-            with open(target_file, "rb") as f:
-                binary_content = f.read()
-            content_b64 = base64.b64encode(binary_content).decode("utf-8")
-            logger.info(f"[FILE_CONTENT] Read binary file as base64: {target_file}, size: {len(binary_content)} bytes")
-            return create_cors_response({"content": content_b64, "encoding": "base64"})
+            file_size = file_stat.st_size
+            if file_size > FILE_CONTENT_STREAM_THRESHOLD:
+                # Large files are streamed so the payload is never held in memory twice
+                logger.info(f"[FILE_CONTENT] Streaming large file: {target_file}, size: {file_size} bytes")
+                return StreamingResponse(
+                    stream_file_content(target_file),
+                    media_type="application/json",
+                    headers={"ETag": etag},
+                )
+
+            async with aiofiles.open(target_file, "rb") as f:
+                raw_content = await f.read()
+            try:
+                content = raw_content.decode("utf-8")
+                logger.info(f"[FILE_CONTENT] Read text file: {target_file}, length: {len(content)}")
+                return create_cors_response({"content": content, "encoding": "utf-8"}, headers={"ETag": etag})
+            except UnicodeDecodeError:
+                logger.info(f"[FILE_CONTENT] File {target_file} is not UTF-8 text, returning base64.")
+                # Encode on a worker thread so large binaries don't stall the event loop
+                content_b64 = await anyio.to_thread.run_sync(b64encode_to_str, raw_content)
+                logger.info(f"[FILE_CONTENT] Read binary file as base64: {target_file}, size: {len(raw_content)} bytes")
+                return create_cors_response({"content": content_b64, "encoding": "base64"}, headers={"ETag": etag})
         except PermissionError:
             logger.error(f"[FILE_CONTENT] Permission denied accessing file: {target_file}")
             return create_cors_response(
@@ -215,6 +559,13 @@ async def get_file_content_endpoint(request: Request):
         )
 
 
+def content_disposition_attachment(filename: str) -> str:
+    """Content-Disposition value for an attachment, RFC 5987-encoding non-ASCII names like FileResponse does."""
+    quoted = quote(filename)
+    if quoted != filename:
+        return f"attachment; filename*=utf-8''{quoted}"
+    return f'attachment; filename="{filename}"'
+
 @router.post("/api/files/download")
 async def download_file_endpoint(request: Request):
     """API endpoint for downloading a single file from a workspace."""
@@ -233,25 +584,49 @@ async def download_file_endpoint(request: Request):
             logger.error("[FILE_DOWNLOAD] Workspace root path not configured.")
             return create_cors_response({"error": "Server configuration error."}, 500)
 
-        workspace_path = Path(current_args.workspace).resolve() / workspace_id
+        workspace_path = resolve_inside(app_config.get_workspace_root(), workspace_id)
+        if workspace_path is None:
+            return create_cors_response({"error": "Access denied"}, 403)
         if not workspace_path.exists():
             return create_cors_response({"error": f"Workspace not found: {workspace_id}"}, 404)
 
-        target_file = (workspace_path / file_path_str).resolve()
-
-        if not str(target_file).startswith(str(workspace_path)): # Security check
+        target_file = resolve_inside(workspace_path, file_path_str)
+        if target_file is None: # Security check
             return create_cors_response({"error": "Access denied"}, 403)
 
-        if not target_file.exists():
+        # One stat serves the existence/type checks and FileResponse's headers
+        try:
+            file_stat = target_file.stat()
+        except FileNotFoundError:
             return create_cors_response({"error": f"File not found: {file_path_str}"}, 404)
-        if not target_file.is_file():
+        if not stat.S_ISREG(file_stat.st_mode):
             return create_cors_response({"error": f"Path is not a file: {file_path_str}"}, 400)
 
+        etag = file_etag(file_stat)
+        if etag_matches(request, etag):
+            return not_modified_response(etag)
+
+        if FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX:
+            # Let the fronting web server (nginx X-Accel-Redirect) send the body with sendfile
+            relative_file = target_file.relative_to(app_config.get_workspace_root()).as_posix()
+            accel_path = f"{FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(relative_file)}"
+            logger.info(f"[FILE_DOWNLOAD] Delegating download of {target_file} to {accel_path}")
+            return Response(
+                media_type='application/octet-stream',
+                headers={
+                    "X-Accel-Redirect": accel_path,
+                    "ETag": etag,
+                    "Content-Disposition": content_disposition_attachment(target_file.name)
+                }
+            )
+
         logger.info(f"[FILE_DOWNLOAD] Preparing file for download: {target_file}")
         return FileResponse(
-            path=str(target_file),
+            path=os.fspath(target_file),
             filename=target_file.name,
-            media_type='application/octet-stream'
+            media_type='application/octet-stream',
+            stat_result=file_stat,
+            headers={"ETag": etag} # Same validator the 304 check above compares against
         )
 
     except Exception as e:
@@ -277,14 +652,15 @@ async def download_zip_endpoint(request: Request):
             logger.error("[ZIP_DOWNLOAD] Workspace root path not configured.")
             return create_cors_response({"error": "Server configuration error."}, 500)
 
-        workspace_path = Path(current_args.workspace).resolve() / workspace_id
+        workspace_path = resolve_inside(app_config.get_workspace_root(), workspace_id)
+        if workspace_path is None:
+            return create_cors_response({"error": "Access denied"}, 403)
         if not workspace_path.exists():
             return create_cors_response({"error": f"Workspace not found: {workspace_id}"}, 404)
 
         # folder_path_str is relative to workspace_id
-        target_folder = (workspace_path / folder_path_str.strip('/')).resolve()
-
-        if not str(target_folder).startswith(str(workspace_path)): # Security check
+        target_folder = resolve_inside(workspace_path, folder_path_str.strip('/'))
+        if target_folder is None: # Security check
             return create_cors_response({"error": "Access denied"}, 403)
         
         if not target_folder.exists():
@@ -292,41 +668,16 @@ async def download_zip_endpoint(request: Request):
         if not target_folder.is_dir():
             return create_cors_response({"error": f"Path is not a directory: {folder_path_str}"}, 400)
 
-        # Create a temporary zip file
-        # tempfile.NamedTemporaryFile is better as it handles cleanup more robustly
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.zip') as tmp_zip_file:
-            zip_file_path = tmp_zip_file.name
-        
-        logger.info(f"[ZIP_DOWNLOAD] Creating zip file at {zip_file_path} for folder {target_folder}")
+        zip_filename = f"{target_folder.name or 'workspace'}.zip"
+        logger.info(f"[ZIP_DOWNLOAD] Streaming zip {zip_filename} for folder {target_folder}")
 
-        try:
-            with zipfile.ZipFile(zip_file_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                for root, dirs, files in os.walk(target_folder):
-                    # Skip hidden directories by modifying dirs in place
-                    dirs[:] = [d for d in dirs if not d.startswith('.')]
-                    
-                    for file_item in files: # Renamed to file_item
-                        if file_item.startswith('.'): # Skip hidden files
-                            continue
-                            
-                        file_full_path = Path(root) / file_item
-                        arcname = file_full_path.relative_to(target_folder)
-                        zipf.write(file_full_path, arcname)
-            
-            zip_filename = f"{target_folder.name or 'workspace'}.zip"
-            logger.info(f"[ZIP_DOWNLOAD] Zip file created: {zip_filename}, size: {Path(zip_file_path).stat().st_size} bytes")
-
-            return FileResponse(
-                path=zip_file_path,
-                filename=zip_filename,
-                media_type='application/zip',
-                background=lambda: os.unlink(zip_file_path) # Ensure temp file is deleted
-            )
-        except Exception as e_zip:
-            logger.error(f"[ZIP_DOWNLOAD] Error during zip creation for {target_folder}: {e_zip}", exc_info=True)
-            if os.path.exists(zip_file_path): # Cleanup on error during zipping
-                os.unlink(zip_file_path)
-            raise HTTPException(status_code=500, detail=f"Error creating zip file: {str(e_zip)}")
+        # A sync generator is iterated in Starlette's threadpool, so compression
+        # never runs on the event loop and bytes reach the client as they are produced.
+        return StreamingResponse(
+            iter_zip_stream(target_folder),
+            media_type='application/zip',
+            headers={"Content-Disposition": content_disposition_attachment(zip_filename)},
+        )
 
     except Exception as e:
         logger.error(f"[ZIP_DOWNLOAD] Error processing zip download request: {str(e)}", exc_info=True)
@@ -1,13 +1,18 @@
 """
 Handles API routes related to running GAIA benchmarks.
 """
+import asyncio
 import os
 import logging
-import json
+import time
 import uuid
-import subprocess
+from collections import deque
+from dataclasses import dataclass, field
 from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional, Tuple
 
+import anyio
+import orjson
 from fastapi import APIRouter, Request, HTTPException
 from fastapi.responses import JSONResponse
 
@@ -17,9 +22,139 @@ from .config import app_config # Relative import
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+GAIA_RUN_TIMEOUT_SECONDS = 3600 # 60 minutes
+GAIA_JOB_RETENTION_SECONDS = 24 * 3600 # Finished jobs are forgotten after a day
+GAIA_LOG_TAIL_LINES = 1000 # Benchmark output lines kept per job
+GAIA_STATUS_LOG_LINES = 50 # Output lines returned by the status endpoint
+GAIA_STREAM_LINE_LIMIT = 1024 * 1024 # StreamReader limit; benchmark output can contain long lines
+
+@dataclass
+class GaiaJob:
+    """State of a benchmark run started via /api/gaia/run."""
+    job_id: str
+    run_name: str
+    set_to_run: str
+    status: str = "queued" # queued -> running -> completed | failed
+    created_at: float = field(default_factory=time.time)
+    finished_at: Optional[float] = None
+    log: Deque[str] = field(default_factory=lambda: deque(maxlen=GAIA_LOG_TAIL_LINES))
+    result: Optional[Dict[str, Any]] = None
+    status_code: int = 200
+    task: Optional[asyncio.Task] = None
+
+# In-memory job registry; holding the job also keeps a strong reference to its task
+JOBS: Dict[str, GaiaJob] = {}
+
+def _prune_finished_jobs() -> None:
+    """Drop finished jobs older than GAIA_JOB_RETENTION_SECONDS."""
+    cutoff = time.time() - GAIA_JOB_RETENTION_SECONDS
+    expired = [job_id for job_id, job in JOBS.items() if job.finished_at is not None and job.finished_at < cutoff]
+    for job_id in expired:
+        del JOBS[job_id]
+
+def _read_results_file(results_file_path: Path) -> Tuple[List[Dict[str, Any]], int]:
+    """Parse a run_gaia.py results file. Returns (records, number of records with a prediction)."""
+    benchmark_results = []
+    # Prediction might be null or empty if a task failed internally in run_gaia.py
+    completed_tasks_with_prediction = 0
+    with open(results_file_path, 'rb') as f:
+        for line in f:
+            if line.strip():
+                try:
+                    record = orjson.loads(line)
+                except orjson.JSONDecodeError as e_json:
+                    logger.warning(f"GAIA API: Failed to parse result line from {results_file_path}: {e_json} - Line: '{line.strip().decode('utf-8', errors='replace')}'")
+                    continue
+                benchmark_results.append(record)
+                if record.get('prediction'):
+                    completed_tasks_with_prediction += 1
+    return benchmark_results, completed_tasks_with_prediction
+
+async def _execute_benchmark(job: GaiaJob, cmd: List[str], env: Dict[str, str], project_root: Path, output_dir: Path) -> Tuple[Dict[str, Any], int]:
+    """Run run_gaia.py for job, streaming its output into job.log. Returns (response payload, status code)."""
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            *cmd,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+            env=env,
+            cwd=str(project_root), # Ensure script runs from project root
+            limit=GAIA_STREAM_LINE_LIMIT
+        )
+    except FileNotFoundError:
+        logger.error("GAIA API: run_gaia.py script not found. Ensure it's in the project root and executable.")
+        return {"status": "error", "message": "run_gaia.py script not found. Check server configuration."}, 500
+
+    async def consume_output() -> int:
+        async for raw_line in proc.stdout:
+            job.log.append(raw_line.decode("utf-8", errors="replace").rstrip())
+        return await proc.wait()
+
+    try:
+        returncode = await asyncio.wait_for(consume_output(), timeout=GAIA_RUN_TIMEOUT_SECONDS)
+    except asyncio.TimeoutError:
+        logger.error(f"GAIA API: Benchmark job {job.job_id} timed out (60 minutes).")
+        return {"status": "error", "message": "Benchmark execution timed out (60 minutes)"}, 408
+    finally:
+        if proc.returncode is None: # Timed out or cancelled (e.g. server shutdown)
+            proc.kill()
+            await proc.wait()
+
+    output_tail = "\n".join(job.log)
+    if returncode != 0:
+        error_msg = f"GAIA API: Benchmark script failed with return code {returncode}. "
+        if output_tail: error_msg += f"Output: {output_tail}"
+        logger.error(error_msg)
+        return {"status": "error", "message": error_msg}, 500
+
+    results_file_path = output_dir / f"{job.run_name}.jsonl"
+    if not results_file_path.exists():
+        error_msg = f"GAIA API: Benchmark script completed but results file not found at {results_file_path}. "
+        if output_tail: error_msg += f"Output: {output_tail}"
+        logger.error(error_msg)
+        return {"status": "error", "message": error_msg}, 404
+
+    # Read and parsed on a worker thread; a large results file must not stall the event loop
+    benchmark_results, completed_tasks_with_prediction = await anyio.to_thread.run_sync(
+        _read_results_file, results_file_path
+    )
+
+    total_tasks_processed = len(benchmark_results)
+    
+    summary_stats = {
+        "total_tasks_processed_by_script": total_tasks_processed,
+        "tasks_with_successful_prediction": completed_tasks_with_prediction,
+        "completion_rate_of_predictions": (completed_tasks_with_prediction / total_tasks_processed) if total_tasks_processed > 0 else 0,
+        "run_name": job.run_name,
+        "set_to_run": job.set_to_run,
+        "results_file": str(results_file_path.relative_to(project_root))
+    }
+    logger.info(f"GAIA API: Benchmark successful. Summary: {summary_stats}")
+    return {
+        "status": "success", 
+        "results": benchmark_results,
+        "summary": summary_stats
+    }, 200
+
+async def _run_benchmark(job: GaiaJob, cmd: List[str], env: Dict[str, str], project_root: Path, output_dir: Path) -> None:
+    """Background task driving a GaiaJob from queued to completed/failed."""
+    job.status = "running"
+    try:
+        job.result, job.status_code = await _execute_benchmark(job, cmd, env, project_root, output_dir)
+    except asyncio.CancelledError:
+        job.result, job.status_code = {"status": "error", "message": "Benchmark job was cancelled"}, 500
+        raise
+    except Exception as e_subproc:
+        logger.error(f"GAIA API: Subprocess error during benchmark job {job.job_id}: {str(e_subproc)}", exc_info=True)
+        job.result = {"status": "error", "message": f"Failed to run benchmark due to subprocess error: {str(e_subproc)}"}
+        job.status_code = 500
+    finally:
+        job.status = "completed" if job.status_code == 200 else "failed"
+        job.finished_at = time.time()
+
 @router.post("/api/gaia/run")
 async def run_gaia_benchmark_endpoint(request: Request):
-    """API endpoint to run GAIA benchmark evaluation."""
+    """API endpoint to start a GAIA benchmark evaluation; returns 202 with a job_id to poll."""
     try:
         # Check for GAIA dependencies (datasets, huggingface_hub)
         try:
@@ -89,73 +224,47 @@ async def run_gaia_benchmark_endpoint(request: Request):
         env["HF_HUB_DISABLE_PROGRESS_BARS"] = "1"
         env["TQDM_DISABLE"] = "1" # For tqdm progress bars
         
-        try:
-            # Using subprocess.Popen for potentially long-running non-blocking execution if needed in future,
-            # but for now, a blocking run with timeout is fine for an API endpoint.
-            result = subprocess.run(
-                cmd, 
-                capture_output=True, 
-                text=True, 
-                timeout=3600,  # 60 minutes
-                env=env,
-                cwd=str(project_root) # Ensure script runs from project root
-            )
-            
-            if result.stdout: logger.debug(f"GAIA API: Benchmark stdout: {result.stdout[:1000]}...")
-            if result.stderr: logger.warning(f"GAIA API: Benchmark stderr: {result.stderr[:1000]}...")
-            
-            if result.returncode == 0:
-                results_file_path = output_dir / f"{run_name}.jsonl"
-                if results_file_path.exists():
-                    benchmark_results = []
-                    with open(results_file_path, 'r') as f:
-                        for line in f:
-                            if line.strip():
-                                try:
-                                    benchmark_results.append(json.loads(line))
-                                except json.JSONDecodeError as e_json:
-                                    logger.warning(f"GAIA API: Failed to parse result line from {results_file_path}: {e_json} - Line: '{line.strip()}'")
-                    
-                    total_tasks_processed = len(benchmark_results)
-                    # Prediction might be null or empty if a task failed internally in run_gaia.py
-                    completed_tasks_with_prediction = len([r for r in benchmark_results if r.get('prediction')]) 
-                    
-                    summary_stats = {
-                        "total_tasks_processed_by_script": total_tasks_processed,
-                        "tasks_with_successful_prediction": completed_tasks_with_prediction,
-                        "completion_rate_of_predictions": (completed_tasks_with_prediction / total_tasks_processed) if total_tasks_processed > 0 else 0,
-                        "run_name": run_name,
-                        "set_to_run": set_to_run,
-                        "results_file": str(results_file_path.relative_to(project_root))
-                    }
-                    logger.info(f"GAIA API: Benchmark successful. Summary: {summary_stats}")
-                    return create_cors_response({
-                        "status": "success", 
-                        "results": benchmark_results,
-                        "summary": summary_stats
-                    })
-                else:
-                    error_msg = f"GAIA API: Benchmark script completed but results file not found at {results_file_path}. "
-                    if result.stderr: error_msg += f"Stderr: {result.stderr}"
-                    logger.error(error_msg)
-                    return create_cors_response({"status": "error", "message": error_msg}, 404)
-            else:
-                error_msg = f"GAIA API: Benchmark script failed with return code {result.returncode}. "
-                if result.stderr: error_msg += f"Error: {result.stderr}"
-                elif result.stdout: error_msg += f"Output: {result.stdout}" # In case error details are in stdout
-                logger.error(error_msg)
-                return create_cors_response({"status": "error", "message": error_msg}, 500)
-                
-        except subprocess.TimeoutExpired:
-            logger.error("GAIA API: Benchmark execution timed out (60 minutes).")
-            return create_cors_response({"status": "error", "message": "Benchmark execution timed out (60 minutes)"}, 408)
-        except FileNotFoundError:
-            logger.error("GAIA API: run_gaia.py script not found. Ensure it's in the project root and executable.")
-            return create_cors_response({"status": "error", "message": "run_gaia.py script not found. Check server configuration."}, 500)
-        except Exception as e_subproc:
-            logger.error(f"GAIA API: Subprocess error during benchmark: {str(e_subproc)}", exc_info=True)
-            return create_cors_response({"status": "error", "message": f"Failed to run benchmark due to subprocess error: {str(e_subproc)}"}, 500)
+        job = GaiaJob(job_id=str(uuid.uuid4()), run_name=run_name, set_to_run=set_to_run)
+        _prune_finished_jobs()
+        JOBS[job.job_id] = job
+        job.task = asyncio.create_task(_run_benchmark(job, cmd, env, project_root, output_dir))
+        logger.info(f"GAIA API: Queued benchmark job {job.job_id} for run {run_name}")
+
+        return create_cors_response({
+            "status": "accepted",
+            "job_id": job.job_id,
+            "run_name": run_name,
+            "status_url": f"/api/gaia/status/{job.job_id}",
+            "result_url": f"/api/gaia/result/{job.job_id}"
+        }, 202)
         
     except Exception as e_main:
         logger.error(f"GAIA API: General error running GAIA benchmark: {str(e_main)}", exc_info=True)
         return create_cors_response({"status": "error", "message": f"Error running GAIA benchmark: {str(e_main)}"}, 500)
+
+@router.get("/api/gaia/status/{job_id}")
+async def get_gaia_status_endpoint(job_id: str):
+    """API endpoint to poll the state of a GAIA benchmark job."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return create_cors_response({"status": "error", "message": f"Unknown job: {job_id}"}, 404)
+    log_tail = list(job.log)[-GAIA_STATUS_LOG_LINES:]
+    return create_cors_response({
+        "job_id": job.job_id,
+        "run_name": job.run_name,
+        "status": job.status,
+        "created_at": job.created_at,
+        "finished_at": job.finished_at,
+        "log_tail": log_tail,
+        "result_url": f"/api/gaia/result/{job.job_id}"
+    })
+
+@router.get("/api/gaia/result/{job_id}")
+async def get_gaia_result_endpoint(job_id: str):
+    """API endpoint returning the final response of a GAIA benchmark job (202 while still running)."""
+    job = JOBS.get(job_id)
+    if job is None:
+        return create_cors_response({"status": "error", "message": f"Unknown job: {job_id}"}, 404)
+    if job.finished_at is None:
+        return create_cors_response({"status": job.status, "job_id": job.job_id, "status_url": f"/api/gaia/status/{job.job_id}"}, 202)
+    return create_cors_response(job.result, job.status_code)
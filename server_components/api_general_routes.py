@@ -1,29 +1,128 @@
 """
 Handles general API routes like file uploads and transcription.
 """
+import asyncio
+import functools
 import os
+import stat
 import logging
 import base64
 from pathlib import Path
-import requests # Added for transcribe_audio_endpoint
 import json # Added for transcribe_audio_endpoint
+from typing import Any, Dict, Optional, Tuple
 
-from fastapi import APIRouter, Request, HTTPException
-from fastapi.responses import JSONResponse
+import aiofiles
+import anyio
+from fastapi import APIRouter, File, Form, Request, HTTPException, UploadFile
+from fastapi.responses import Response
 
 from ii_agent.utils.constants import UPLOAD_FOLDER_NAME
-from .common import create_cors_response, CORS_HEADERS # Relative import
+from .api_file_routes import resolve_inside # Same containment check as the file API
+from .common import chutes_post, create_cors_response, summary_cache_key, SUMMARY_CACHE, SUMMARY_INFLIGHT # Relative import
 from .config import app_config # Relative import
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-@router.options("/{full_path:path}")
-async def options_handler(request: Request):
-    """Handle preflight OPTIONS requests for CORS."""
-    headers = CORS_HEADERS.copy()
-    headers["Access-Control-Max-Age"] = "86400" # Typically 24 hours
-    return JSONResponse(content={}, headers=headers)
+UPLOAD_STREAM_CHUNK_SIZE = 1024 * 1024
+
+class UploadPathError(Exception):
+    """The requested upload path points outside the session's upload folder."""
+
+@functools.lru_cache(maxsize=4096)
+def ensure_upload_dir(workspace_root: Path, session_id: str) -> Path:
+    """
+    Create the upload folder of a session workspace once and memoize its path.
+
+    Keyed by the resolved workspace root as well as the session, so new arguments from
+    set_args never hit stale entries. A missing workspace raises FileNotFoundError, which
+    lru_cache does not memoize, so a workspace created later is picked up.
+    """
+    workspace_path = workspace_root / session_id
+    if not workspace_path.is_dir():
+        raise FileNotFoundError(str(workspace_path))
+    upload_dir = workspace_path / UPLOAD_FOLDER_NAME
+    upload_dir.mkdir(exist_ok=True)
+    return upload_dir
+
+def get_upload_dir(workspace_root: Path, session_id: str) -> Optional[Path]:
+    """Return (creating it if needed) the upload folder of a session workspace, or None if the workspace doesn't exist.
+
+    workspace_root must already be resolved (app_config.get_workspace_root()).
+    """
+    try:
+        return ensure_upload_dir(workspace_root, session_id)
+    except FileNotFoundError:
+        logger.error(f"Upload API: Workspace not found for session: {session_id} at {workspace_root / session_id}")
+        return None
+
+def make_upload_subfolders(upload_dir: Path, folder: Path) -> None:
+    """
+    Create folder and any missing folders between it and upload_dir. upload_dir itself
+    and everything above it are never created, so a removed workspace stays removed
+    (FileNotFoundError).
+    """
+    current = upload_dir
+    for part in folder.relative_to(upload_dir).parts:
+        current = current / part
+        current.mkdir(exist_ok=True)
+
+def open_unique_upload(upload_dir: Path, file_path_str: str) -> Tuple[int, Path, str]:
+    """
+    Create and open the target file of an upload without clobbering an existing one.
+
+    Names are claimed atomically with O_CREAT|O_EXCL, so concurrent uploads of the same
+    name can't both win; on collision _1, _2, _4, ... is appended to the stem, keeping
+    the number of attempts logarithmic in the number of existing copies.
+    Returns (writable fd, full path, path relative to upload_dir); parent folders below
+    upload_dir are created. Raises FileNotFoundError if upload_dir no longer exists and
+    UploadPathError if file_path_str leads outside upload_dir (.., symlinks).
+    """
+    # Ensure the file path is relative to the workspace
+    if Path(file_path_str).is_absolute():
+        file_path_str = Path(file_path_str).name
+
+    target = resolve_inside(upload_dir, file_path_str)
+    if target is None or target == upload_dir:
+        raise UploadPathError(f"Upload path is outside the upload folder: {file_path_str}")
+    if target.parent != upload_dir:
+        make_upload_subfolders(upload_dir, target.parent)
+
+    base_name = target.stem
+    extension = target.suffix
+    counter = 0
+    while True:
+        full_path = target if counter == 0 else target.with_name(f"{base_name}_{counter}{extension}")
+        try:
+            fd = os.open(full_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        except FileExistsError:
+            counter = counter * 2 or 1
+            continue
+        except FileNotFoundError:
+            # upload_dir itself is gone: prepare_upload_target re-checks the workspace
+            if full_path.parent == upload_dir:
+                raise
+            # A subfolder was removed since it was created (raises if upload_dir went too)
+            make_upload_subfolders(upload_dir, full_path.parent)
+            continue
+        return fd, full_path, str(full_path.relative_to(upload_dir))
+
+def prepare_upload_target(workspace_root: Path, session_id: str, file_path_str: str) -> Optional[Tuple[int, Path, str]]:
+    """get_upload_dir + open_unique_upload in one call, so endpoints need a single worker-thread hop."""
+    upload_dir = get_upload_dir(workspace_root, session_id)
+    if upload_dir is None:
+        return None
+    try:
+        return open_unique_upload(upload_dir, file_path_str)
+    except FileNotFoundError:
+        # The memoized upload folder was removed, possibly with its whole workspace (admin
+        # cleanup): forget it and check the workspace again, which answers None if it's gone
+        logger.info(f"Upload API: Upload folder {upload_dir} was removed; re-checking workspace for session {session_id}")
+        ensure_upload_dir.cache_clear()
+        upload_dir = get_upload_dir(workspace_root, session_id)
+        if upload_dir is None:
+            return None
+        return open_unique_upload(upload_dir, file_path_str)
 
 @router.post("/api/upload")
 async def upload_file_endpoint(request: Request):
@@ -51,16 +150,6 @@ async def upload_file_endpoint(request: Request):
             logger.error("Upload API: Workspace path not configured in app_config.")
             return create_cors_response({"error": "Server configuration error: Workspace path missing."}, 500)
 
-        workspace_path = Path(current_args.workspace).resolve() / session_id
-        if not workspace_path.exists():
-            logger.error(f"Upload API: Workspace not found for session: {session_id} at {workspace_path}")
-            return create_cors_response(
-                {"error": f"Workspace not found for session: {session_id}"}, 404
-            )
-
-        upload_dir = workspace_path / UPLOAD_FOLDER_NAME
-        upload_dir.mkdir(parents=True, exist_ok=True)
-
         file_path_str = file_info.get("path", "")
         file_content = file_info.get("content", "")
 
@@ -68,35 +157,23 @@ async def upload_file_endpoint(request: Request):
             logger.error("Upload API: File path is required")
             return create_cors_response({"error": "File path is required"}, 400)
 
-        # Ensure the file path is relative to the workspace
-        if Path(file_path_str).is_absolute():
-            file_path_str = Path(file_path_str).name
-
-        original_path = upload_dir / file_path_str
-        full_path = original_path
-        final_file_path_str = file_path_str # Store the potentially modified path
-
-        if full_path.exists():
-            base_name = full_path.stem
-            extension = full_path.suffix
-            counter = 1
-            while full_path.exists():
-                new_filename = f"{base_name}_{counter}{extension}"
-                full_path = upload_dir / new_filename
-                counter += 1
-            final_file_path_str = str(full_path.relative_to(upload_dir))
-
-
-        full_path.parent.mkdir(parents=True, exist_ok=True)
-
+        # Decode before claiming the target name so bad input doesn't leave an empty file behind
         if file_content.startswith("data:"):
             header, encoded = file_content.split(",", 1)
-            decoded = base64.b64decode(encoded)
-            with open(full_path, "wb") as f:
-                f.write(decoded)
+            file_bytes = await anyio.to_thread.run_sync(base64.b64decode, encoded)
         else:
-            with open(full_path, "w", encoding='utf-8') as f: # Specify encoding
-                f.write(file_content)
+            file_bytes = file_content.encode("utf-8")
+
+        # exists/mkdir/collision probing are blocking syscalls; run them off the event loop
+        upload_target = await anyio.to_thread.run_sync(prepare_upload_target, app_config.get_workspace_root(), session_id, file_path_str)
+        if upload_target is None:
+            return create_cors_response(
+                {"error": f"Workspace not found for session: {session_id}"}, 404
+            )
+        fd, full_path, final_file_path_str = upload_target
+
+        async with aiofiles.open(fd, "wb") as f: # Takes ownership of fd and closes it
+            await f.write(file_bytes)
 
         logger.info(f"Upload API: File uploaded to {full_path}")
         relative_path = f"/{UPLOAD_FOLDER_NAME}/{final_file_path_str}"
@@ -106,12 +183,80 @@ async def upload_file_endpoint(request: Request):
             "file": {"path": relative_path, "saved_path": str(full_path)},
         })
 
+    except UploadPathError as e:
+        logger.error(f"Upload API: {e}")
+        return create_cors_response({"error": "Invalid file path"}, 400)
     except Exception as e:
         logger.error(f"Upload API: Error uploading file: {str(e)}", exc_info=True)
         return create_cors_response(
             {"error": f"Error uploading file: {str(e)}"}, 500
         )
 
+@router.post("/api/upload_stream")
+async def upload_file_stream_endpoint(
+    session_id: Optional[str] = Form(None),
+    file: Optional[UploadFile] = File(None),
+    path: Optional[str] = Form(None),
+):
+    """API endpoint for uploading a single file to the workspace as multipart/form-data.
+
+    Unlike /api/upload the file is streamed to disk in chunks, so memory use stays
+    flat regardless of file size. Form fields:
+    - session_id: UUID of the session/workspace
+    - file: The file part
+    - path: Optional target path inside the upload folder (defaults to the file name)
+    """
+    try:
+        if not session_id:
+            logger.error("Upload Stream API: session_id is required")
+            return create_cors_response({"error": "session_id is required"}, 400)
+
+        if file is None:
+            logger.error("Upload Stream API: No file provided for upload")
+            return create_cors_response({"error": "No file provided for upload"}, 400)
+
+        current_args = app_config.get_args()
+        if not current_args or not hasattr(current_args, 'workspace'):
+            logger.error("Upload Stream API: Workspace path not configured in app_config.")
+            return create_cors_response({"error": "Server configuration error: Workspace path missing."}, 500)
+
+        file_path_str = path or file.filename
+        if not file_path_str:
+            logger.error("Upload Stream API: File path is required")
+            return create_cors_response({"error": "File path is required"}, 400)
+
+        # exists/mkdir/collision probing are blocking syscalls; run them off the event loop
+        upload_target = await anyio.to_thread.run_sync(prepare_upload_target, app_config.get_workspace_root(), session_id, file_path_str)
+        if upload_target is None:
+            return create_cors_response(
+                {"error": f"Workspace not found for session: {session_id}"}, 404
+            )
+        fd, full_path, final_file_path_str = upload_target
+
+        async with aiofiles.open(fd, "wb") as f: # Takes ownership of fd and closes it
+            while chunk := await file.read(UPLOAD_STREAM_CHUNK_SIZE):
+                await f.write(chunk)
+
+        logger.info(f"Upload Stream API: File uploaded to {full_path}")
+        relative_path = f"/{UPLOAD_FOLDER_NAME}/{final_file_path_str}"
+
+        return create_cors_response({
+            "message": "File uploaded successfully",
+            "file": {"path": relative_path, "saved_path": str(full_path)},
+        })
+
+    except UploadPathError as e:
+        logger.error(f"Upload Stream API: {e}")
+        return create_cors_response({"error": "Invalid file path"}, 400)
+    except Exception as e:
+        logger.error(f"Upload Stream API: Error uploading file: {str(e)}", exc_info=True)
+        return create_cors_response(
+            {"error": f"Error uploading file: {str(e)}"}, 500
+        )
+    finally:
+        if file is not None:
+            await file.close()
+
 @router.post("/api/transcribe")
 async def transcribe_audio_endpoint(request: Request):
     """API endpoint for transcribing audio using Chutes Whisper API.
@@ -140,14 +285,13 @@ async def transcribe_audio_endpoint(request: Request):
 
         logger.info('Transcription API: Found API key, making request to Chutes...')
         
-        response = requests.post(
+        response = await chutes_post(
             'https://chutes-whisper-large-v3.chutes.ai/transcribe',
             headers={
                 'Authorization': f'Bearer {api_token}',
                 'Content-Type': 'application/json',
             },
             json={'audio_b64': audio_b64},
-            timeout=30
         )
 
         logger.info(f'Transcription API: Chutes response status: {response.status_code}')
@@ -161,26 +305,98 @@ async def transcribe_audio_endpoint(request: Request):
             return create_cors_response({"transcription": transcription})
         else:
             error_text = response.text
-            logger.error(f'CHUTES transcription failed: {response.status_code} {response.reason} {error_text}')
+            logger.error(f'CHUTES transcription failed: {response.status_code} {response.reason_phrase} {error_text}')
             return create_cors_response({"error": "Transcription failed"}, 500)
 
     except Exception as e:
         logger.error(f'Error in transcription API: {str(e)}', exc_info=True)
         return create_cors_response({"error": "Internal server error"}, 500)
 
+async def request_task_summary(message: str, cache_key: bytes, api_key: str) -> Tuple[Dict[str, Any], int]:
+    """Ask the Chutes LLM for a short summary of message. Returns (response content, status code)."""
+    # Always use a known supported model for summary generation
+    model_id = "deepseek-ai/DeepSeek-V3-0324" # Use a model we know works with Chutes API
+    logger.info(f'Generate Summary API: Found API key, making request to Chutes with model {model_id}...')
+    
+    api_url = "https://llm.chutes.ai/v1/chat/completions"
+    
+    response = await chutes_post(
+        api_url,
+        headers={
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json",
+        },
+        json={
+            "model": model_id,
+            "messages": [
+                {
+                    "role": "system",
+                    "content": "You are a helpful assistant that creates very short, concise summaries of user tasks. Your summaries should be 3-7 words maximum, capturing the essence of what the user wants to do. Be specific but brief. You must respond with a JSON object in the format: {\"summary\": \"your short summary here\"}"
+                },
+                {
+                    "role": "user",
+                    "content": f"Create a very short summary (3-7 words) of this task: \"{message}\""
+                }
+            ],
+            "response_format": {"type": "json_object"},
+            "temperature": 0.3,
+            "max_tokens": 50,
+        },
+    )
+
+    logger.info(f'Generate Summary API: Response status code: {response.status_code}')
+    
+    if response.status_code == 200:
+        response_data = response.json()
+        content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
+        
+        logger.info(f'Generate Summary API: Raw response content: {content}')
+        
+        summary = "Task in progress" # Default summary
+        try:
+            parsed_content = json.loads(content)
+            summary = parsed_content.get("summary", summary) # Use default if key missing
+            logger.info(f'Generate Summary API: Parsed summary: {summary}')
+            SUMMARY_CACHE[cache_key] = summary # Only real model answers are cached, not the fallback
+        except json.JSONDecodeError as e:
+            logger.warning(f"Generate Summary API: Failed to parse summary JSON: {content}, error: {e}")
+        
+        return {"summary": summary}, 200
+    else:
+        error_text = response.text
+        logger.error(f"Generate Summary API: Chutes API error: {response.status_code} {error_text}")
+        error_detail = "Failed to generate summary"
+        try:
+            error_data = response.json()
+            error_detail = error_data.get("detail", error_data.get("error", {"message": error_detail}).get("message", error_detail))
+        except:
+            pass # Keep default error_detail
+        return {"error": error_detail}, response.status_code
+
 @router.post("/api/generate-summary")
 async def generate_summary_endpoint(request: Request):
     """Generate a short task summary using Chutes API."""
     try:
         data = await request.json()
         message = data.get("message")
-        # Always use a known supported model for summary generation
-        model_id = "deepseek-ai/DeepSeek-V3-0324" # Use a model we know works with Chutes API
 
         if not message:
             logger.error("Generate Summary API: Message is required")
             return create_cors_response({"error": "Message is required"}, 400)
 
+        cache_key = summary_cache_key(message)
+        cached_summary = SUMMARY_CACHE.get(cache_key)
+        if cached_summary is not None:
+            logger.info(f'Generate Summary API: Cache hit, summary: {cached_summary}')
+            return create_cors_response({"summary": cached_summary})
+
+        # Single-flight: identical messages arriving while a request is outstanding share its result
+        inflight = SUMMARY_INFLIGHT.get(cache_key)
+        if inflight is not None:
+            logger.info('Generate Summary API: Joining in-flight request for the same message')
+            content, status_code = await asyncio.shield(inflight)
+            return create_cors_response(content, status_code)
+
         api_key = os.getenv("CHUTES_API_KEY")
         
         logger.info('Generate Summary API: Checking for CHUTES_API_KEY...')
@@ -188,62 +404,17 @@ async def generate_summary_endpoint(request: Request):
             logger.error('Generate Summary API: CHUTES_API_KEY environment variable not found')
             return create_cors_response({"error": "API key not configured"}, 500)
 
-        logger.info(f'Generate Summary API: Found API key, making request to Chutes with model {model_id}...')
-        
-        api_url = "https://llm.chutes.ai/v1/chat/completions"
-        
-        response = requests.post(
-            api_url,
-            headers={
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json",
-            },
-            json={
-                "model": model_id,
-                "messages": [
-                    {
-                        "role": "system",
-                        "content": "You are a helpful assistant that creates very short, concise summaries of user tasks. Your summaries should be 3-7 words maximum, capturing the essence of what the user wants to do. Be specific but brief. You must respond with a JSON object in the format: {\"summary\": \"your short summary here\"}"
-                    },
-                    {
-                        "role": "user",
-                        "content": f"Create a very short summary (3-7 words) of this task: \"{message}\""
-                    }
-                ],
-                "response_format": {"type": "json_object"},
-                "temperature": 0.3,
-                "max_tokens": 50,
-            },
-            timeout=30
-        )
-
-        logger.info(f'Generate Summary API: Response status code: {response.status_code}')
-        
-        if response.status_code == 200:
-            response_data = response.json()
-            content = response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
-            
-            logger.info(f'Generate Summary API: Raw response content: {content}')
-            
-            summary = "Task in progress" # Default summary
-            try:
-                parsed_content = json.loads(content)
-                summary = parsed_content.get("summary", summary) # Use default if key missing
-                logger.info(f'Generate Summary API: Parsed summary: {summary}')
-            except json.JSONDecodeError as e:
-                logger.warning(f"Generate Summary API: Failed to parse summary JSON: {content}, error: {e}")
-            
-            return create_cors_response({"summary": summary})
-        else:
-            error_text = response.text
-            logger.error(f"Generate Summary API: Chutes API error: {response.status_code} {error_text}")
-            error_detail = "Failed to generate summary"
-            try:
-                error_data = response.json()
-                error_detail = error_data.get("detail", error_data.get("error", {"message": error_detail}).get("message", error_detail))
-            except:
-                pass # Keep default error_detail
-            return create_cors_response({"error": error_detail}, response.status_code)
+        inflight = asyncio.get_running_loop().create_future()
+        SUMMARY_INFLIGHT[cache_key] = inflight
+        try:
+            content, status_code = await request_task_summary(message, cache_key, api_key)
+            inflight.set_result((content, status_code))
+        finally:
+            if not inflight.done():
+                # Failed or cancelled: waiters get the same answer this request's handler gives
+                inflight.set_result(({"error": "Internal server error"}, 500))
+            SUMMARY_INFLIGHT.pop(cache_key, None)
+        return create_cors_response(content, status_code)
 
     except Exception as e:
         logger.error(f"Generate Summary API: Error generating summary: {str(e)}", exc_info=True)
@@ -251,23 +422,39 @@ async def generate_summary_endpoint(request: Request):
 
 MAINTENANCE_FILE_PATH = Path("data/maintenance.txt")
 
+# ((st_mtime_ns, st_size), message) of the last read of MAINTENANCE_FILE_PATH; clients poll
+# the endpoint, so the file is only re-read when a stat shows it changed.
+_maintenance_cache: Optional[Tuple[Tuple[int, int], Optional[str]]] = None
+
 @router.get("/api/maintenance_message")
 async def get_maintenance_message_endpoint(request: Request):
     """
     API endpoint to get the maintenance message.
     Checks for a maintenance.txt file in the data directory.
     """
+    global _maintenance_cache
     try:
+        try:
+            file_stat = os.stat(MAINTENANCE_FILE_PATH)
+        except (FileNotFoundError, NotADirectoryError):
+            return create_cors_response({"message": None})
+        if not stat.S_ISREG(file_stat.st_mode):
+            return create_cors_response({"message": None})
+
+        file_version = (file_stat.st_mtime_ns, file_stat.st_size)
+        if _maintenance_cache is not None and _maintenance_cache[0] == file_version:
+            return create_cors_response({"message": _maintenance_cache[1]})
+
         message_content = None
-        if MAINTENANCE_FILE_PATH.exists() and MAINTENANCE_FILE_PATH.is_file():
-            try:
-                message_content = MAINTENANCE_FILE_PATH.read_text(encoding="utf-8").strip()
-                logger.info(f"Maintenance message found: {message_content[:100]}...") # Log first 100 chars
-            except Exception as e:
-                logger.error(f"Error reading maintenance file {MAINTENANCE_FILE_PATH}: {str(e)}", exc_info=True)
-                # If file exists but can't be read, we might still want to indicate no specific message
-                # or return an error. For now, let's treat it as no message.
-                message_content = None
+        try:
+            message_content = MAINTENANCE_FILE_PATH.read_text(encoding="utf-8").strip()
+            logger.info(f"Maintenance message found: {message_content[:100]}...") # Log first 100 chars
+            _maintenance_cache = (file_version, message_content)
+        except Exception as e:
+            logger.error(f"Error reading maintenance file {MAINTENANCE_FILE_PATH}: {str(e)}", exc_info=True)
+            # If file exists but can't be read, we might still want to indicate no specific message
+            # or return an error. For now, let's treat it as no message.
+            message_content = None
         
         return create_cors_response({"message": message_content})
 
@@ -276,3 +463,15 @@ async def get_maintenance_message_endpoint(request: Request):
         return create_cors_response(
             {"error": "Error retrieving maintenance message"}, 500
         )
+
+# Browsers that once registered a service worker for this origin keep requesting /sw.js.
+# An empty script they may cache for a year stops the repeated (and logged) 404s.
+SW_JS_STUB_HEADERS = {
+    "Cache-Control": "public, max-age=31536000, immutable",
+    "ETag": '"sw-empty"',
+}
+
+@router.get("/sw.js")
+async def service_worker_stub():
+    """Serve an empty service worker script."""
+    return Response(b"", media_type="application/javascript", headers=SW_JS_STUB_HEADERS)
@@ -3,17 +3,45 @@ Handles API routes related to user sessions and events.
 """
 import logging
 import time
-import json
+from datetime import datetime
+from typing import Iterator, List, Optional, Tuple
 from fastapi import APIRouter, HTTPException, Request
-from sqlalchemy import asc, text, and_, func
+from fastapi.responses import StreamingResponse
+import orjson
+from sqlalchemy import String, and_, asc, bindparam, or_, text, type_coerce
 
-from ii_agent.db.manager import DatabaseManager
 from ii_agent.db.models import Session, Event # Ensure direct import for clarity
-from .common import create_cors_response # Relative import
+from .common import create_cors_response, get_db_manager # Relative import
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
+# Page size cap for /events; also the default, which keeps unparameterized clients whole
+EVENTS_PAGE_MAX = 1000
+# Rows fetched per cursor round-trip and serialized per streamed chunk
+EVENTS_STREAM_BATCH = 100
+
+# Earliest user_message text per session, in one query. json_valid guards json_extract,
+# which would otherwise fail the whole statement on a single malformed payload.
+FIRST_USER_MESSAGES_SQL = text("""
+    WITH RankedMessages AS (
+        SELECT
+            session_id,
+            event_payload,
+            ROW_NUMBER() OVER(PARTITION BY session_id ORDER BY timestamp ASC) AS rn
+        FROM event
+        WHERE session_id IN :session_ids
+        AND event_type = 'user_message'
+    )
+    SELECT
+        session_id,
+        CASE WHEN json_valid(event_payload)
+            THEN json_extract(event_payload, '$.content.text')
+        END AS first_text
+    FROM RankedMessages
+    WHERE rn = 1
+""").bindparams(bindparam("session_ids", expanding=True))
+
 @router.get("/api/sessions/{device_id}")
 async def get_sessions_by_device_id(device_id: str):
     """Get all sessions for a specific device ID, sorted by creation time descending.
@@ -21,147 +49,46 @@ async def get_sessions_by_device_id(device_id: str):
     """
     try:
         start_time = time.time()
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
 
         with db_manager.get_session() as db_sess: # Renamed to db_sess to avoid conflict
-            sessions_query = db_sess.query(Session).filter(
+            # Plain column tuples: no ORM identity-map hydration for a read-only listing
+            sessions_query = db_sess.query(
+                Session.id,
+                Session.workspace_dir,
+                Session.created_at,
+                Session.device_id,
+                Session.summary,
+            ).filter(
                 Session.device_id == device_id
             ).order_by(Session.created_at.desc()).limit(50)
             
-            sessions_list = sessions_query.all()
-            
             sessions_data = []
-            for sess_model in sessions_list: # Renamed to sess_model
-                session_item = { # Renamed to session_item
-                    "id": sess_model.id,
-                    "workspace_dir": sess_model.workspace_dir,
-                    "created_at": sess_model.created_at.isoformat() if sess_model.created_at else None,
-                    "device_id": sess_model.device_id,
-                    "summary": sess_model.summary,
+            for row in sessions_query:
+                sessions_data.append({
+                    "id": row.id,
+                    "workspace_dir": row.workspace_dir,
+                    "created_at": row.created_at.isoformat() if row.created_at else None,
+                    "device_id": row.device_id,
+                    "summary": row.summary,
                     "first_message": "",
-                }
-                sessions_data.append(session_item)
+                })
             
             if sessions_data:
                 session_ids = [s["id"] for s in sessions_data]
-                first_messages_map = {}
-
+                # One indexed pass over event (idx_event_session_type_ts) picks each session's
+                # earliest user_message and extracts its text in SQLite, so payloads are never
+                # decoded in Python; session ids are bound as a single expanding parameter.
+                # No slower fallback paths: on failure the error is logged and the sessions
+                # are still returned, with empty first messages.
                 try:
-                    # ORM approach
-                    subquery = db_sess.query(
-                        Event.session_id,
-                        func.min(Event.timestamp).label('min_timestamp')
-                    ).filter(
-                        Event.session_id.in_(session_ids),
-                        Event.event_type == 'user_message'
-                    ).group_by(Event.session_id).subquery()
-                    
-                    first_messages_results = db_sess.query(Event).join(
-                        subquery,
-                        and_(
-                            Event.session_id == subquery.c.session_id,
-                            Event.timestamp == subquery.c.min_timestamp,
-                            Event.event_type == 'user_message' # Ensure we only get user_message type
-                        )
-                    ).all()
-                    
-                    for event in first_messages_results:
-                        try:
-                            # Handle both string and already deserialized dict payloads
-                            if isinstance(event.event_payload, str):
-                                payload = json.loads(event.event_payload) if event.event_payload else {}
-                            elif isinstance(event.event_payload, dict):
-                                payload = event.event_payload
-                            else:
-                                logger.warning(f"Unexpected payload type for event {event.id}: {type(event.event_payload)}")
-                                payload = {}
-                            
-                            first_message_text = payload.get("content", {}).get("text", "")
-                            first_messages_map[event.session_id] = first_message_text
-                        except json.JSONDecodeError:
-                            logger.warning(f"Could not parse event_payload for event {event.id}")
-                            first_messages_map[event.session_id] = "" # Default to empty if payload is malformed
-                        except Exception as e_payload:
-                            logger.error(f"Unexpected error processing payload for event {event.id}: {e_payload}")
-                            first_messages_map[event.session_id] = ""
-
-
-                    logger.info(f"ORM approach: Retrieved first messages for {len(first_messages_map)} sessions.")
-
-                except Exception as e_orm:
-                    logger.warning(f"ORM approach for first messages failed: {e_orm}, trying raw SQL.")
-                    try:
-                        # Raw SQL approach
-                        params = {f'param_{i}': sid for i, sid in enumerate(session_ids)}
-                        placeholders = ','.join([f':param_{i}' for i in range(len(session_ids))])
-                        
-                        # Corrected SQL to fetch the event_payload of the first 'user_message'
-                        # This query ensures we get the payload associated with the MIN(timestamp)
-                        first_messages_query_sql = text(f"""
-                        WITH RankedMessages AS (
-                            SELECT
-                                session_id,
-                                event_payload,
-                                ROW_NUMBER() OVER(PARTITION BY session_id ORDER BY timestamp ASC) as rn
-                            FROM event
-                            WHERE session_id IN ({placeholders})
-                            AND event_type = 'user_message'
-                        )
-                        SELECT session_id, event_payload
-                        FROM RankedMessages
-                        WHERE rn = 1;
-                        """)
-                        
-                        result = db_sess.execute(first_messages_query_sql, params)
-                        
-                        for row in result:
-                            try:
-                                # Handle both string and already deserialized dict payloads
-                                if isinstance(row.event_payload, str):
-                                    payload = json.loads(row.event_payload) if row.event_payload else {}
-                                elif isinstance(row.event_payload, dict):
-                                    payload = row.event_payload
-                                else:
-                                    logger.warning(f"Raw SQL: Unexpected payload type for session {row.session_id}: {type(row.event_payload)}")
-                                    payload = {}
-                                
-                                first_message_text = payload.get("content", {}).get("text", "")
-                                first_messages_map[row.session_id] = first_message_text
-                            except json.JSONDecodeError:
-                                logger.warning(f"Raw SQL: Could not parse event_payload for session {row.session_id}")
-                                first_messages_map[row.session_id] = ""
-                            except Exception as e_payload_sql:
-                                logger.error(f"Raw SQL: Unexpected error processing payload for session {row.session_id}: {e_payload_sql}")
-                                first_messages_map[row.session_id] = ""
-                        logger.info(f"Raw SQL approach: Retrieved first messages for {len(first_messages_map)} sessions.")
-
-                    except Exception as e_sql:
-                        logger.warning(f"Raw SQL approach for first messages failed: {e_sql}, falling back to individual queries.")
-                        # Fallback: Individual queries (less efficient)
-                        for sess_item in sessions_data[:10]: # Limit fallback to avoid excessive queries
-                            try:
-                                first_event = db_sess.query(Event).filter(
-                                    Event.session_id == sess_item["id"],
-                                    Event.event_type == 'user_message'
-                                ).order_by(Event.timestamp.asc()).first()
-                                if first_event and first_event.event_payload:
-                                    # Handle both string and already deserialized dict payloads
-                                    if isinstance(first_event.event_payload, str):
-                                        payload = json.loads(first_event.event_payload)
-                                    elif isinstance(first_event.event_payload, dict):
-                                        payload = first_event.event_payload
-                                    else:
-                                        logger.warning(f"Fallback: Unexpected payload type for session {sess_item['id']}: {type(first_event.event_payload)}")
-                                        payload = {}
-                                    
-                                    first_messages_map[sess_item["id"]] = payload.get("content", {}).get("text", "")
-                                else:
-                                    first_messages_map[sess_item["id"]] = ""
-                            except Exception as e_fallback:
-                                logger.error(f"Fallback: Error getting first message for session {sess_item['id']}: {e_fallback}")
-                                first_messages_map[sess_item["id"]] = ""
-                        logger.info(f"Fallback approach: Retrieved first messages for {len(first_messages_map)} sessions (limited).")
-                
+                    result = db_sess.execute(FIRST_USER_MESSAGES_SQL, {"session_ids": session_ids})
+                    first_messages_map = {row.session_id: row.first_text or "" for row in result}
+                    logger.info(f"Retrieved first messages for {len(first_messages_map)} sessions.")
+                except Exception as e:
+                    logger.error(f"Error retrieving first messages for device {device_id}: {str(e)}", exc_info=True)
+                    first_messages_map = {}
+
                 for sess_item in sessions_data:
                     sess_item["first_message"] = first_messages_map.get(sess_item["id"], "")
             
@@ -186,7 +113,7 @@ async def update_session_summary(session_id: str, request: Request):
             logger.error("Update Summary API: Summary is required")
             return create_cors_response({"error": "Summary is required"}, 400)
 
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
         with db_manager.get_session() as db_sess:
             session = db_sess.query(Session).filter(Session.id == session_id).first()
 
@@ -206,40 +133,124 @@ async def update_session_summary(session_id: str, request: Request):
             status_code=500, detail=f"Error updating summary: {str(e)}"
         )
 
+def iter_session_events_json(
+    session_id: str,
+    workspace_dir: Optional[str],
+    total_count: int,
+    after_key: Optional[Tuple[datetime, str]],
+    limit: int,
+    start_time: float,
+) -> Iterator[bytes]:
+    """Yield the /events JSON body, EVENTS_STREAM_BATCH rows per chunk.
+
+    Rows are fetched through a server-side cursor (yield_per) so neither the result set
+    nor the full body is held in memory. The counts and the cursor for the next page are
+    only known once the rows are consumed, so they follow the events array.
+    """
+    returned_count = 0
+    last_id = None
+    batch: List[bytes] = []
+
+    yield b'{"events":['
+    with get_db_manager().get_session() as db_sess:
+        # The payload is read as its stored JSON text (type_coerce skips the JSON type's
+        # decoding) and embedded verbatim via orjson.Fragment, so it is never parsed
+        # and re-serialized; clients still receive it as a JSON object.
+        events_query = (
+            db_sess.query(
+                Event.id,
+                Event.session_id,
+                Event.timestamp,
+                Event.event_type,
+                type_coerce(Event.event_payload, String).label("event_payload_json"),
+            )
+            .filter(Event.session_id == session_id)
+        )
+        if after_key is not None:
+            # (timestamp, id) keyset so events sharing a timestamp are neither skipped nor repeated
+            after_ts, after_id = after_key
+            events_query = events_query.filter(
+                or_(
+                    Event.timestamp > after_ts,
+                    and_(Event.timestamp == after_ts, Event.id > after_id),
+                )
+            )
+        events_query = (
+            events_query.order_by(asc(Event.timestamp), asc(Event.id))
+            .limit(limit)
+            .yield_per(EVENTS_STREAM_BATCH)
+        )
+
+        for row in events_query:
+            batch.append(orjson.dumps({
+                "id": row.id,
+                "session_id": row.session_id,
+                "timestamp": row.timestamp.isoformat(),
+                "event_type": row.event_type,
+                "event_payload": orjson.Fragment(row.event_payload_json or "null"),
+                "workspace_dir": workspace_dir,
+            }))
+            last_id = row.id
+            returned_count += 1
+            if len(batch) == EVENTS_STREAM_BATCH:
+                yield (b"," if returned_count > EVENTS_STREAM_BATCH else b"") + b",".join(batch)
+                batch.clear()
+
+    if batch:
+        yield (b"," if returned_count > len(batch) else b"") + b",".join(batch)
+
+    trailer = orjson.dumps({
+        "total_count": total_count,
+        "returned_count": returned_count,
+        "next_after_id": last_id if returned_count == limit else None,
+    })
+    # Splice the trailer object's members in after the array: drop its opening brace
+    yield b"]," + trailer[1:]
+
+    query_time = time.time() - start_time
+    logger.info(f"get_session_events for {session_id} completed in {query_time:.3f}s. Returned {returned_count} of {total_count} events.")
+
 @router.get("/api/sessions/{session_id}/events")
-async def get_session_events(session_id: str):
-    """Get all events for a specific session ID, sorted by timestamp ascending."""
+async def get_session_events(session_id: str, after_id: Optional[str] = None, limit: int = EVENTS_PAGE_MAX):
+    """Get events for a specific session ID, sorted by timestamp ascending.
+
+    Keyset-paginated: pass the previous response's ``next_after_id`` as ``after_id`` to
+    continue. ``limit`` is capped at EVENTS_PAGE_MAX; without parameters the first
+    EVENTS_PAGE_MAX events are returned as before. The body is streamed in batches of rows.
+    """
     try:
         start_time = time.time()
-        db_manager = DatabaseManager()
+        limit = max(1, min(limit, EVENTS_PAGE_MAX))
+        db_manager = get_db_manager()
 
         with db_manager.get_session() as db_sess: # Renamed to db_sess
             total_count = db_sess.query(Event).filter(Event.session_id == session_id).count()
             logger.info(f"Session {session_id} has {total_count} total events.")
             
-            events_query = (
-                db_sess.query(Event)
-                .filter(Event.session_id == session_id)
-                .order_by(asc(Event.timestamp))
-                .limit(1000) # Keep limit for performance
-                .all()
+            # Identical for every event of the session: one scalar lookup instead of a lazy
+            # load of e_model.session per row.
+            workspace_dir = (
+                db_sess.query(Session.workspace_dir)
+                .filter(Session.id == session_id)
+                .scalar()
             )
 
-            event_list = []
-            for e_model in events_query: # Renamed to e_model
-                event_list.append({
-                    "id": e_model.id,
-                    "session_id": e_model.session_id,
-                    "timestamp": e_model.timestamp.isoformat(),
-                    "event_type": e_model.event_type,
-                    "event_payload": e_model.event_payload,
-                    # Access related session safely
-                    "workspace_dir": e_model.session.workspace_dir if e_model.session else None,
-                })
+            after_key = None
+            if after_id:
+                after_ts = (
+                    db_sess.query(Event.timestamp)
+                    .filter(Event.id == after_id, Event.session_id == session_id)
+                    .scalar()
+                )
+                if after_ts is None:
+                    logger.error(f"Events API: Unknown after_id {after_id} for session {session_id}")
+                    return create_cors_response({"error": "Unknown after_id"}, 400)
+                after_key = (after_ts, after_id)
 
-            query_time = time.time() - start_time
-            logger.info(f"get_session_events for {session_id} completed in {query_time:.3f}s. Returned {len(event_list)} of {total_count} events.")
-            return create_cors_response({"events": event_list, "total_count": total_count, "returned_count": len(event_list)})
+        return StreamingResponse(
+            iter_session_events_json(session_id, workspace_dir, total_count, after_key, limit, start_time),
+            media_type="application/json",
+        )
 
     except Exception as e:
         logger.error(f"Error retrieving events for session {session_id}: {str(e)}", exc_info=True)
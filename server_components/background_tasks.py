@@ -0,0 +1,129 @@
+"""
+Scheduler for the server's periodic background jobs.
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from enum import IntEnum
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Priority(IntEnum):
+    """Order among jobs that are due at the same time; lower runs first."""
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+@dataclass
+class PeriodicJob:
+    func: Callable[[], Awaitable[Optional[float]]]
+    interval: float
+    priority: Priority
+    name: str
+
+class BackgroundTaskScheduler:
+    """
+    Runs periodic async jobs from a single dispatcher task.
+
+    Due jobs start in priority order with at most max_concurrent running at once, and a
+    job never overlaps itself: its next run is scheduled interval seconds after the
+    previous run finished. A run may return a different delay for its next run (e.g. to
+    back off while there is nothing to do); returning None keeps interval. A failing run
+    is logged and the job stays scheduled.
+    """
+    def __init__(self, max_concurrent: int = 4):
+        self.max_concurrent = max_concurrent
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._jobs: List[PeriodicJob] = []
+        # (due monotonic time, priority, insertion order, job)
+        self._heap: List[Tuple[float, int, int, PeriodicJob]] = []
+        # Jobs already due, waiting for a free slot: (priority, insertion order, job)
+        self._ready: List[Tuple[int, int, PeriodicJob]] = []
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    def add(
+        self,
+        func: Callable[[], Awaitable[Optional[float]]],
+        interval: float,
+        priority: Priority = Priority.NORMAL,
+        name: Optional[str] = None,
+    ) -> None:
+        """Register func to run every interval seconds; the first run is one interval after start()."""
+        job = PeriodicJob(func, interval, priority, name or func.__name__)
+        self._jobs.append(job)
+        if self._dispatcher is not None:
+            self._schedule(job, job.interval)
+
+    def _schedule(self, job: PeriodicJob, delay: float) -> None:
+        heapq.heappush(self._heap, (time.monotonic() + delay, job.priority, next(self._sequence), job))
+        self._wakeup.set()
+
+    async def start(self) -> None:
+        if self._dispatcher is not None:
+            return
+        for job in self._jobs:
+            self._schedule(job, job.interval)
+        self._dispatcher = asyncio.create_task(self._dispatch(), name="background-task-scheduler")
+        logger.info(f"Background task scheduler started with {len(self._jobs)} job(s): {', '.join(job.name for job in self._jobs)}")
+
+    async def stop(self) -> None:
+        """Cancel the dispatcher and any running jobs and wait for them to finish."""
+        dispatcher, self._dispatcher = self._dispatcher, None
+        tasks = [task for task in (dispatcher, *self._running) if task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+        self._heap.clear()
+        self._ready.clear()
+        logger.info("Background task scheduler stopped.")
+
+    def _collect_due(self) -> None:
+        """Move every job whose due time has passed to the ready queue."""
+        now = time.monotonic()
+        while self._heap and self._heap[0][0] <= now:
+            _, priority, sequence, job = heapq.heappop(self._heap)
+            heapq.heappush(self._ready, (priority, sequence, job))
+
+    async def _dispatch(self) -> None:
+        while True:
+            self._wakeup.clear()
+            self._collect_due()
+            if not self._ready:
+                if not self._heap:
+                    await self._wakeup.wait()
+                    continue
+                # Woken early when a job is (re)scheduled, since it may now be the first due
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self._heap[0][0] - time.monotonic())
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self._semaphore.acquire()
+            # Jobs that came due while waiting for a slot compete on priority as well
+            self._collect_due()
+            job = heapq.heappop(self._ready)[2]
+            task = asyncio.create_task(self._run(job), name=f"background-job:{job.name}")
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def _run(self, job: PeriodicJob) -> None:
+        delay = None
+        try:
+            delay = await job.func()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Background job {job.name} failed: {e}", exc_info=True)
+        finally:
+            self._semaphore.release()
+        if self._dispatcher is not None:
+            self._schedule(job, job.interval if delay is None else delay)
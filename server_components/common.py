@@ -1,29 +1,125 @@
 """
 Common utilities and constants shared across server components.
 """
+import asyncio
+import functools
 import logging
-from fastapi.responses import JSONResponse
-from typing import Dict, Any
+import hashlib
+import httpx
+from cachetools import TTLCache
+import orjson
+from fastapi.responses import Response
+from typing import Dict, Any, Optional, Tuple
+
+from ii_agent.db.manager import DatabaseManager
 
 # Create a logger for this module
 logger = logging.getLogger(__name__)
 
-# CORS headers for API responses
-CORS_HEADERS: Dict[str, str] = {
-    "Access-Control-Allow-Origin": "*",
-    "Access-Control-Allow-Methods": "GET, POST, PUT, DELETE, OPTIONS, HEAD, PATCH",
-    "Access-Control-Allow-Headers": "*",
-}
+class ORJSONResponse(Response):
+    """
+    JSON response rendered by orjson straight to bytes.
+
+    Naive datetimes are emitted as UTC (the DB stores utcnow()), numpy values are
+    supported, and anything else orjson can't encode natively (e.g. Path) falls back to str().
+    """
+    media_type = "application/json"
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(
+            content,
+            default=str,
+            option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+        )
+
+def create_cors_response(content: Dict[str, Any], status_code: int = 200, headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    """
+    Create a JSON response serialized with orjson, with optional extra headers (e.g. ETag).
+    CORS headers are added to every response, including preflights and errors, by the
+    CORSMiddleware installed in ws_server.py.
+    """
+    return ORJSONResponse(content=content, status_code=status_code, headers=headers)
+
+@functools.lru_cache(maxsize=None)
+def get_db_manager() -> DatabaseManager:
+    """
+    Process-wide DatabaseManager. Constructing one creates an engine and runs the schema
+    migrations and create_all, so handlers share this instance instead of building their own.
+    """
+    return DatabaseManager()
+
+# Shared async HTTP client for outbound API calls (Chutes). Opened and closed with the
+# application lifecycle so connections and TLS sessions are reused across requests.
+HTTP_CLIENT_TIMEOUT = httpx.Timeout(connect=5.0, read=30.0, write=10.0, pool=5.0)
+HTTP_CLIENT_LIMITS = httpx.Limits(max_keepalive_connections=50, max_connections=100, keepalive_expiry=60.0)
+# Retries for failed connection attempts only; a request that reached the server is never replayed
+HTTP_CLIENT_CONNECT_RETRIES = 2
+_http_client: Optional[httpx.AsyncClient] = None
 
-def create_cors_response(content: Dict[str, Any], status_code: int = 200) -> JSONResponse:
+def get_http_client() -> httpx.AsyncClient:
+    """
+    Return the shared httpx.AsyncClient, creating it on first use if the startup
+    hook has not run (e.g. when the app is served by `uvicorn ws_server:app`).
     """
-    Create a JSONResponse with CORS headers.
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        # Pool limits and HTTP/2 live on the transport once one is passed explicitly
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            limits=HTTP_CLIENT_LIMITS,
+            retries=HTTP_CLIENT_CONNECT_RETRIES,
+        )
+        _http_client = httpx.AsyncClient(timeout=HTTP_CLIENT_TIMEOUT, transport=transport)
+    return _http_client
+
+async def close_http_client() -> None:
+    """Close the shared HTTP client; called on application shutdown."""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+        logger.info("Shared HTTP client closed.")
+
+# Back-pressure for calls to the Chutes APIs: at most CHUTES_MAX_CONCURRENCY requests are
+# in flight per process, and overload/gateway statuses are retried with exponential backoff.
+CHUTES_MAX_CONCURRENCY = 32
+CHUTES_SEM = asyncio.Semaphore(CHUTES_MAX_CONCURRENCY)
+CHUTES_RETRY_STATUSES = frozenset({429, 502, 503, 504})
+CHUTES_MAX_ATTEMPTS = 4
+CHUTES_RETRY_BASE_DELAY = 0.25
+CHUTES_RETRY_MAX_DELAY = 8.0
+
+async def chutes_post(url: str, **kwargs: Any) -> httpx.Response:
     """
-    return JSONResponse(
-        content=content,
-        status_code=status_code,
-        headers=CORS_HEADERS
-    )
+    POST to a Chutes endpoint through the shared client, bounded by CHUTES_SEM.
+
+    429/502/503/504 responses are retried up to CHUTES_MAX_ATTEMPTS times, doubling the
+    delay each time (a numeric Retry-After is honoured, capped at CHUTES_RETRY_MAX_DELAY).
+    The semaphore is released while backing off. The last response is returned as-is.
+    """
+    delay = CHUTES_RETRY_BASE_DELAY
+    for attempt in range(1, CHUTES_MAX_ATTEMPTS + 1):
+        async with CHUTES_SEM:
+            response = await get_http_client().post(url, **kwargs)
+        if response.status_code not in CHUTES_RETRY_STATUSES or attempt == CHUTES_MAX_ATTEMPTS:
+            return response
+
+        retry_after = response.headers.get("retry-after", "")
+        wait = min(float(retry_after), CHUTES_RETRY_MAX_DELAY) if retry_after.isdigit() else delay
+        logger.warning(f"Chutes API: {url} returned {response.status_code}, retrying in {wait:.2f}s (attempt {attempt}/{CHUTES_MAX_ATTEMPTS})")
+        await asyncio.sleep(wait)
+        delay = min(delay * 2, CHUTES_RETRY_MAX_DELAY)
+    return response
+
+# Task summaries from /api/generate-summary keyed by summary_cache_key(message); repeat
+# prompts are answered from memory instead of another LLM round trip.
+SUMMARY_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+
+def summary_cache_key(message: str) -> bytes:
+    return hashlib.blake2b(message.encode("utf-8"), digest_size=16).digest()
+
+# Outstanding summary requests by cache key; resolves to (response content, status code)
+SUMMARY_INFLIGHT: Dict[bytes, "asyncio.Future[Tuple[Dict[str, Any], int]]"] = {}
 
 # Placeholder for other common utilities that might be identified during refactoring
 # For example, constants related to WebSocket event types if they are used across modules.
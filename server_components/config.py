@@ -2,8 +2,8 @@
 Manages global application configuration, primarily command-line arguments.
 """
 import argparse
+import functools
 import logging
-from typing import Optional
 from pathlib import Path
 import os
 
@@ -18,31 +18,64 @@ class AppConfig:
     def __new__(cls, *args, **kwargs):
         if not cls._instance:
             cls._instance = super(AppConfig, cls).__new__(cls, *args, **kwargs)
-            cls._instance.args = None
+            # Built eagerly so get_args is a plain attribute read; set_args replaces it at startup
+            cls._instance.args = cls._create_fallback_args()
+            cls._instance.args_set = False
+            cls._instance.workspace_root = None
         return cls._instance
 
     def set_args(self, args: argparse.Namespace):
         """
         Sets the command-line arguments. This should be called once at startup.
         """
-        if self.args is not None:
+        if self.args_set:
             logger.warning("Application arguments are being re-set. This is unusual.")
         self.args = args
+        self.args_set = True
+        self.workspace_root = None # Re-resolved lazily for the new args
+        self.__dict__.pop("static_file_base_url", None) # Likewise recomputed from the new args
         logger.info(f"Application arguments set: {args}")
 
-    def get_args(self) -> Optional[argparse.Namespace]:
+    def get_args(self) -> argparse.Namespace:
         """
-        Retrieves the stored command-line arguments.
+        Retrieves the stored command-line arguments, or the fallback defaults if
+        set_args has not been called yet.
         """
-        if self.args is None:
-            logger.error("Application arguments accessed before being set. Creating fallback default args.")
-            # Create fallback default arguments to prevent server crash
-            self.args = self._create_fallback_args()
-            logger.info(f"Fallback arguments created: {self.args}")
         return self.args
+
+    def get_workspace_root(self) -> Path:
+        """
+        Returns the resolved workspace root. Resolving walks every path component,
+        so it is done once per set of arguments instead of on every request.
+        """
+        if self.workspace_root is None:
+            self.workspace_root = Path(self.get_args().workspace).resolve()
+        return self.workspace_root
     
-    def _create_fallback_args(self) -> argparse.Namespace:
-        """Create fallback default arguments if none were set during startup."""
+    def ensure_directories(self) -> None:
+        """
+        Create the workspace and log directories of the current arguments (the fallback
+        defaults if set_args was never called). Run at startup by server_setup.lifespan.
+        """
+        args = self.get_args()
+        os.makedirs(args.workspace, exist_ok=True)
+        logs_dir = os.path.dirname(getattr(args, "logs_path", None) or "")
+        if logs_dir:
+            os.makedirs(logs_dir, exist_ok=True)
+
+    @functools.cached_property
+    def static_file_base_url(self) -> str:
+        """
+        Base URL under which workspace files are served: STATIC_FILE_BASE_URL if set,
+        otherwise derived from the server's --host/--port.
+        """
+        return os.environ.get("STATIC_FILE_BASE_URL") or (
+            f"http://{getattr(self.args, 'host', '0.0.0.0')}:{getattr(self.args, 'port', 8000)}"
+        )
+
+    @staticmethod
+    def _create_fallback_args() -> argparse.Namespace:
+        """Create fallback default arguments, used until set_args is called at startup."""
         # Use persistent storage if available, otherwise local directories
         if os.path.exists("/var/data"):
             workspace_default = "/var/data/workspaces"
@@ -51,10 +84,7 @@ class AppConfig:
             workspace_default = "./workspace"
             logs_default = "agent_logs.txt"
         
-        # Ensure directories exist
-        os.makedirs(workspace_default, exist_ok=True)
-        os.makedirs(os.path.dirname(logs_default), exist_ok=True)
-        
+        # Directories are created by ensure_directories at startup, not on import
         fallback_args = argparse.Namespace()
         fallback_args.workspace = workspace_default
         fallback_args.logs_path = logs_default
@@ -67,6 +97,7 @@ class AppConfig:
         fallback_args.context_manager = "file-based"
         fallback_args.use_caching = False
         
+        logger.info(f"Fallback arguments created: {fallback_args}")
         return fallback_args
 
 # Global instance of AppConfig
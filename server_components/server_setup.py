@@ -3,45 +3,91 @@ Handles server startup, argument parsing, and initial workspace setup.
 """
 import os
 import argparse
+import functools
+import importlib.util
 import logging
-import asyncio # For startup/shutdown events if needed for websocket_manager cleanup
-from pathlib import Path
-
-import uvicorn
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from contextlib import asynccontextmanager
+from typing import TYPE_CHECKING, AsyncIterator
 
 from utils import parse_common_args # Assuming utils.py is in PYTHONPATH
 from ii_agent.utils.constants import PERSISTENT_DATA_ROOT # For logging workspace type
 
 from .config import app_config # Relative import
-# Import the periodic cleanup start/stop functions from websocket_manager
-from .websocket_manager import start_periodic_cleanup, stop_periodic_cleanup
-from ii_agent.db.manager import DatabaseManager
-from sqlalchemy import inspect, text
+from .common import close_http_client, get_db_manager, get_http_client
+
+# uvicorn, StaticFiles, sqlalchemy and websocket_manager are imported where they are used,
+# so parsing arguments (e.g. --help) doesn't pay for loading them.
+if TYPE_CHECKING:
+    from fastapi import FastAPI
 
 logger = logging.getLogger(__name__)
 
+# Normalized once; workspace paths are compared against it component-wise
+ABS_PERSISTENT_DATA_ROOT = os.path.abspath(PERSISTENT_DATA_ROOT)
+
+def is_persistent_path(path: str) -> bool:
+    """True if path is PERSISTENT_DATA_ROOT or below it (so /var/data2 is not)."""
+    return os.path.commonpath([os.path.abspath(path), ABS_PERSISTENT_DATA_ROOT]) == ABS_PERSISTENT_DATA_ROOT
+
+WORKSPACE_MOUNT_NAME = "workspace_files"
+
+# Request paths whose uvicorn access log lines are dropped
+SUPPRESSED_ACCESS_LOG_PATHS = frozenset({"/sw.js"})
+
 # Custom log filter to suppress /sw.js access logs
 class SwJsFilter(logging.Filter):
     def filter(self, record: logging.LogRecord) -> bool:
         # For uvicorn.access, record.args is typically a tuple like:
         # (client_addr (str), method (str), path (str), http_version (str), status_code (int))
         # Example: ('127.0.0.1:12345', 'GET', '/sw.js', 'HTTP/1.1', 200)
-        if hasattr(record, 'args') and isinstance(record.args, tuple) and len(record.args) >= 3:
-            path = record.args[2]
-            if isinstance(path, str) and path.endswith("/sw.js"):
-                return False  # Do not log this record
-        return True  # Log all other records
+        # Runs for every request, so it is one membership test; records shaped differently
+        # (no args, shorter tuple, unhashable entry) are simply logged.
+        try:
+            return record.args[2] not in SUPPRESSED_ACCESS_LOG_PATHS
+        except (TypeError, IndexError, KeyError):
+            return True
+
+@asynccontextmanager
+async def lifespan(app: "FastAPI") -> AsyncIterator[None]:
+    """
+    Application lifespan: background tasks and shared clients live between startup and
+    shutdown. Passed to FastAPI(lifespan=...) in ws_server.py, so it also runs when the
+    app is served directly by `uvicorn ws_server:app`.
+    """
+    from .background_tasks import BackgroundTaskScheduler, Priority
+    from .websocket_manager import CONNECTION_CLEANUP_INTERVAL_SECONDS, cleanup_stale_connections
+
+    logger.info("FastAPI application startup triggered.")
+    app_config.ensure_directories() # Workspace and log folders, including for fallback args
+    # All periodic jobs run under one scheduler, which never overlaps runs of a job
+    scheduler = BackgroundTaskScheduler(max_concurrent=4)
+    scheduler.add(cleanup_stale_connections, interval=CONNECTION_CLEANUP_INTERVAL_SECONDS, priority=Priority.NORMAL)
+    await scheduler.start()
+    app.state.background_scheduler = scheduler
+    get_http_client() # Create the shared outbound HTTP client (Chutes API)
+    try:
+        yield
+    finally:
+        logger.info("FastAPI application shutdown triggered.")
+        await scheduler.stop() # Cancels and awaits the WebSocket connection cleanup job
+        await close_http_client() # Close pooled outbound connections (Chutes API)
+        # Add any other global resource cleanup here if necessary
+
+# uvicorn[standard] ships uvloop (not on Windows) and httptools; fall back to the pure-Python
+# asyncio loop and h11 parser where they are unavailable.
+UVICORN_LOOP = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+UVICORN_HTTP = "httptools" if importlib.util.find_spec("httptools") else "h11"
 
 def migrate_database():
     """
     Checks if the 'summary' column exists in the 'session' table
     and adds it if it doesn't. This is an additive, non-destructive migration.
     """
+    from sqlalchemy import inspect, text
+
     try:
         logger.info("Checking database schema for necessary migrations...")
-        db_manager = DatabaseManager()
+        db_manager = get_db_manager()
         engine = db_manager.get_engine()
         inspector = inspect(engine)
 
@@ -49,7 +95,7 @@ def migrate_database():
         columns = [col['name'] for col in inspector.get_columns(table_name)]
 
         if 'summary' not in columns:
-            logger.info(f"Column 'summary' not found in '{table_name}' table. Adding it now...")
+            logger.info("Column 'summary' not found in '%s' table. Adding it now...", table_name)
             with engine.connect() as connection:
                 # Use a transactional block
                 with connection.begin():
@@ -62,11 +108,11 @@ def migrate_database():
     except Exception as e:
         # Catching specific exceptions like sqlalchemy.exc.NoSuchTableError might be better
         # but a general catch is safer for this simple migration.
-        logger.error(f"An error occurred during database migration: {e}", exc_info=True)
+        logger.error("An error occurred during database migration: %s", e, exc_info=True)
         # Depending on the error, you might want to exit the application.
         # For now, we'll log it and continue.
 
-def setup_workspace_static_files(app: FastAPI, workspace_path_str: str):
+def setup_workspace_static_files(app: "FastAPI", workspace_path_str: str):
     """
     Sets up the static file serving for the workspace directory.
     The workspace_path_str should be the root path where session workspaces are created.
@@ -75,36 +121,63 @@ def setup_workspace_static_files(app: FastAPI, workspace_path_str: str):
     this approach might need refinement (e.g. a wildcard route or individual mounts).
     For now, mirroring the original behavior of mounting the base workspace path.
     """
-    workspace_path = Path(workspace_path_str)
-    # Ensure the base workspace directory exists
-    os.makedirs(workspace_path, exist_ok=True)
+    # Re-entry (reloads, repeated main_server_start) must not mount a second copy
+    if any(getattr(route, "name", None) == WORKSPACE_MOUNT_NAME for route in app.routes):
+        logger.info("Workspace static files already mounted at /workspace; skipping.")
+        return
+
+    from .static_files import WorkspaceStaticFiles
+
+    workspace_path = workspace_path_str
+    # Ensure the base workspace directory exists; on restarts it normally does, so a
+    # single stat is all this costs
+    try:
+        os.stat(workspace_path)
+    except FileNotFoundError:
+        os.makedirs(workspace_path, exist_ok=True)
     
     try:
         # This makes the content of args.workspace available under /workspace URL
         app.mount(
             "/workspace", # The URL path
-            StaticFiles(directory=workspace_path, html=True), # The filesystem path
-            name="workspace_files", # A name for this static mount
+            WorkspaceStaticFiles(directory=workspace_path, html=True), # The filesystem path
+            name=WORKSPACE_MOUNT_NAME, # A name for this static mount
         )
-        logger.info(f"Static file serving for base workspace mounted at /workspace, from directory: {workspace_path}")
+        logger.info("Static file serving for base workspace mounted at /workspace, from directory: %s", workspace_path)
         
-        if str(workspace_path).startswith(PERSISTENT_DATA_ROOT):
+        # Kept on app.state so handlers can pick policies (e.g. caching) without re-checking
+        app.state.workspace_is_persistent = is_persistent_path(workspace_path)
+        if app.state.workspace_is_persistent:
             logger.info("Workspace files are being served from persistent storage.")
         else:
             logger.info("Workspace files are being served from local/ephemeral storage.")
             
     except RuntimeError as e:
-        logger.error(f"Failed to mount workspace static files at {workspace_path}: {e}", exc_info=True)
+        logger.error("Failed to mount workspace static files at %s: %s", workspace_path, e, exc_info=True)
         # Depending on severity, might re-raise or attempt to create and mount again
         # For now, logging the error. The application might still run but file serving from workspace might fail.
 
 
-def main_server_start(app: FastAPI):
+class ServerArgumentParser(argparse.ArgumentParser):
     """
-    Main entry point for parsing arguments and starting the Uvicorn server.
-    The FastAPI app instance is passed in.
+    ArgumentParser that also reads arguments from files given as @path. Each line may hold
+    several whitespace-separated arguments; blank lines and lines starting with # are ignored.
+    """
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("fromfile_prefix_chars", "@")
+        super().__init__(*args, **kwargs)
+
+    def convert_arg_line_to_args(self, arg_line: str):
+        if arg_line.lstrip().startswith("#"):
+            return []
+        return arg_line.split()
+
+@functools.cache
+def build_server_parser() -> argparse.ArgumentParser:
     """
-    parser = argparse.ArgumentParser(
+    The fully wired server argument parser, built once and reused.
+    """
+    parser = ServerArgumentParser(
         description="Agent WebSocket Server"
     )
     # Use the parse_common_args from the existing utils.py
@@ -116,25 +189,49 @@ def main_server_start(app: FastAPI):
     parser.add_argument(
         "--port", type=int, default=8000, help="Port to run the server on"
     )
+    parser.add_argument(
+        "--backlog", type=int, default=4096, help="Maximum number of pending TCP connections"
+    )
+    parser.add_argument(
+        "--timeout-keep-alive", type=int, default=30,
+        help="Seconds an idle keep-alive HTTP connection is held open",
+    )
+    parser.add_argument(
+        "--limit-concurrency", type=int, default=1024,
+        help="Maximum concurrent connections and tasks before responding with 503 (0 for no limit)",
+    )
     # Add any other server-specific arguments here if they were in the original main()
 
-    args = parser.parse_args()
-    
+    return parser
+
+@functools.cache
+def parse_server_args() -> argparse.Namespace:
+    """
+    Parse the server command line once; later calls return the same Namespace.
+    """
+    return build_server_parser().parse_args()
+
+def main_server_start(app: "FastAPI"):
+    """
+    Main entry point for parsing arguments and starting the Uvicorn server.
+    The FastAPI app instance is passed in.
+    """
+    args = parse_server_args()
+    import uvicorn # Only needed once arguments parsed successfully
+
     # Store parsed args in the global AppConfig instance
     app_config.set_args(args)
-    logger.info(f"Application arguments parsed and stored: {args}")
+    logger.info("Application arguments parsed and stored: %s", args)
 
     # Run database migration before starting the server
     migrate_database()
 
     # Set STATIC_FILE_BASE_URL environment variable if not already set
-    # This is used by some tools to construct full URLs to workspace files
-    if not os.getenv("STATIC_FILE_BASE_URL"):
-        static_base_url = f"http://{args.host}:{args.port}" # Use parsed host and port
-        os.environ["STATIC_FILE_BASE_URL"] = static_base_url
-        logger.info(f"STATIC_FILE_BASE_URL automatically set to: {static_base_url}")
-    else:
-        logger.info(f"STATIC_FILE_BASE_URL already set: {os.getenv('STATIC_FILE_BASE_URL')}")
+    # This is used by some tools to construct full URLs to workspace files; server code
+    # reads app_config.static_file_base_url, which is computed once from env/args
+    static_base_url = app_config.static_file_base_url
+    os.environ["STATIC_FILE_BASE_URL"] = static_base_url
+    logger.info("STATIC_FILE_BASE_URL: %s", static_base_url)
 
     # Setup static file serving for the main workspace directory
     # args.workspace is expected from parse_common_args
@@ -143,34 +240,38 @@ def main_server_start(app: FastAPI):
     else:
         logger.warning("Workspace argument not found in parsed args. Static file serving for workspace might not be set up.")
 
-    # Define startup and shutdown events for the FastAPI app
-    @app.on_event("startup")
-    async def on_app_startup():
-        logger.info("FastAPI application startup event triggered.")
-        start_periodic_cleanup() # Start the WebSocket connection cleanup task
-
-    @app.on_event("shutdown")
-    async def on_app_shutdown():
-        logger.info("FastAPI application shutdown event triggered.")
-        stop_periodic_cleanup() # Stop the WebSocket connection cleanup task
-        # Add any other global resource cleanup here if necessary
-
     # Add filter to uvicorn.access logger to suppress /sw.js logs
     access_logger = logging.getLogger("uvicorn.access")
-    access_logger.addFilter(SwJsFilter())
+    sw_js_filter = SwJsFilter()
+    access_logger.addFilter(sw_js_filter)
     logger.info("Added SwJsFilter to uvicorn.access logger to suppress /sw.js logs.")
 
-    logger.info(f"Starting Uvicorn server on {args.host}:{args.port}")
+    logger.info("Starting Uvicorn server on %s:%s (loop=%s, http=%s)", args.host, args.port, UVICORN_LOOP, UVICORN_HTTP)
     try:
-        uvicorn.run(
+        config = uvicorn.Config(
             app, # The FastAPI app instance
             host=args.host,
             port=args.port,
+            loop=UVICORN_LOOP,
+            http=UVICORN_HTTP,
+            ws="websockets",
+            # Agent events are small JSON frames; deflating each costs more CPU than it saves
+            # in bandwidth, and every deflate context holds tens of KiB per connection
+            ws_per_message_deflate=False,
+            backlog=args.backlog,
+            timeout_keep_alive=args.timeout_keep_alive,
+            limit_concurrency=args.limit_concurrency or None,
+            access_log=True,
             # Consider adding log_level from args if needed, e.g., uvicorn_log_level=args.log_level.lower()
         )
+        # uvicorn.Config installs the access log handlers (configure_logging); filter on them
+        # too, so records reaching them by any route are dropped before they are formatted
+        for handler in access_logger.handlers:
+            handler.addFilter(sw_js_filter)
+        uvicorn.Server(config).run()
     except KeyboardInterrupt:
         logger.info("Server shutdown requested (KeyboardInterrupt).")
     except Exception as e:
-        logger.critical(f"Uvicorn server failed to start or crashed: {e}", exc_info=True)
+        logger.critical("Uvicorn server failed to start or crashed: %s", e, exc_info=True)
         # Potentially re-raise or exit with error code
         raise # Re-raise the exception to ensure failure is visible
@@ -0,0 +1,115 @@
+"""
+StaticFiles variant used for the /workspace mount.
+"""
+import os
+import re
+import logging
+import mimetypes
+import stat
+from typing import FrozenSet
+from urllib.parse import quote
+
+from fastapi import Request
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import FileResponse, Response
+from fastapi.staticfiles import StaticFiles
+from starlette.types import ASGIApp
+
+from .api_file_routes import ( # Same validators and nginx hand-off as the file API
+    FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX,
+    INCOMPRESSIBLE_EXTENSIONS,
+    etag_matches,
+    file_etag,
+)
+
+logger = logging.getLogger(__name__)
+
+# Workspace files are rewritten by the agent, so browsers must revalidate them; the ETag
+# turns an unchanged file into a bodyless 304.
+WORKSPACE_CACHE_CONTROL = "no-cache"
+# Names carrying a content hash (app.3f9a1c2d.js, index-0b7e44f1.css) never change content
+WORKSPACE_IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# A run of 8+ hex digits mixing digits and letters (so words and dates don't qualify),
+# right before the extension
+FINGERPRINTED_NAME_RE = re.compile(r"[.-](?=[0-9a-f]*[0-9])(?=[0-9a-f]*[a-f])[0-9a-f]{8,}\.[^/.]+$")
+
+# On-the-fly gzip for compressible files without a precompressed sibling
+WORKSPACE_GZIP_MIN_SIZE = 1024
+WORKSPACE_GZIP_LEVEL = 5
+# Precompressed siblings (foo.js.br, foo.js.gz) in order of preference
+PRECOMPRESSED_VARIANTS = (("br", ".br"), ("gzip", ".gz"))
+
+def accepted_encodings(accept_encoding: str) -> FrozenSet[str]:
+    """Content codings listed in an Accept-Encoding header, leaving out those refused with q=0."""
+    encodings = set()
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        if params.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+            continue
+        encodings.add(coding.strip().lower())
+    return frozenset(encodings)
+
+def workspace_cache_control(full_path: str) -> str:
+    """Cache-Control for a workspace file: immutable if its name is fingerprinted, else no-cache."""
+    if FINGERPRINTED_NAME_RE.search(os.path.basename(full_path)):
+        return WORKSPACE_IMMUTABLE_CACHE_CONTROL
+    return WORKSPACE_CACHE_CONTROL
+
+class WorkspaceStaticFiles(StaticFiles):
+    """
+    StaticFiles that sends a size/mtime ETag and a Cache-Control policy with every file,
+    answering a matching If-None-Match with 304 Not Modified.
+
+    Compressible files are sent compressed when the client accepts it: from a precompressed
+    foo.js.br / foo.js.gz next to the file if there is one (no work per request), otherwise
+    gzipped on the fly.
+
+    Uncompressed files are sent with FileResponse, or handed to the fronting nginx
+    via X-Accel-Redirect when FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX is set (the mount serves
+    the workspace root, which that location maps onto).
+    """
+    def identity_response(self, full_path: str, stat_result: os.stat_result, status_code: int, headers: dict) -> Response:
+        if FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX and status_code == 200 and self.directory is not None:
+            relative_file = os.path.relpath(full_path, os.path.realpath(self.directory)).replace(os.sep, "/")
+            accel_path = f"{FILE_DOWNLOAD_ACCEL_REDIRECT_PREFIX.rstrip('/')}/{quote(relative_file)}"
+            media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+            return Response(media_type=media_type, headers={**headers, "X-Accel-Redirect": accel_path})
+        return FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope, status_code: int = 200) -> ASGIApp:
+        request = Request(scope)
+        full_path = str(full_path)
+        etag = file_etag(stat_result)
+        headers = {"ETag": etag, "Cache-Control": workspace_cache_control(full_path)}
+        if status_code == 200 and etag_matches(request, etag):
+            return Response(status_code=304, headers=headers)
+
+        if os.path.splitext(full_path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return self.identity_response(full_path, stat_result, status_code, headers)
+
+        headers["Vary"] = "Accept-Encoding"
+        encodings = accepted_encodings(request.headers.get("accept-encoding", ""))
+        for encoding, suffix in PRECOMPRESSED_VARIANTS:
+            if encoding not in encodings:
+                continue
+            try:
+                variant_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            # A sibling older than the file it was made from is stale
+            if stat.S_ISREG(variant_stat.st_mode) and variant_stat.st_mtime_ns >= stat_result.st_mtime_ns:
+                media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+                return FileResponse(
+                    full_path + suffix,
+                    status_code=status_code,
+                    stat_result=variant_stat,
+                    media_type=media_type,
+                    headers={**headers, "Content-Encoding": encoding},
+                )
+
+        if "gzip" in encodings and stat_result.st_size >= WORKSPACE_GZIP_MIN_SIZE:
+            del headers["Vary"] # GZipMiddleware adds it
+            response = FileResponse(full_path, status_code=status_code, stat_result=stat_result, headers=headers)
+            # An ASGI app like any Response; StaticFiles just awaits it with the request's scope
+            return GZipMiddleware(response, minimum_size=WORKSPACE_GZIP_MIN_SIZE, compresslevel=WORKSPACE_GZIP_LEVEL)
+        return self.identity_response(full_path, stat_result, status_code, headers)
@@ -2,37 +2,43 @@
 Manages WebSocket connections, agent lifecycle, and message processing for the server.
 """
 import asyncio
-import json
+import collections
+import functools
 import logging
+import threading
 import uuid
-from datetime import datetime
+import weakref
+from dataclasses import dataclass
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, List, Set, Any, Optional, Tuple
+from typing import AsyncIterator, Awaitable, Callable, Deque, Dict, List, Any, Optional, Set, Tuple
 import time
 import os # For os.getenv
 
 import anyio
+import orjson
 from fastapi import WebSocket, WebSocketDisconnect
+from starlette.websockets import WebSocketState
 
 # Imports from original ws_server.py that are relevant here
-from ii_agent.core.event import RealtimeEvent, EventType
+from ii_agent.core.event import RealtimeEvent, EventType, encode_frame
 from ii_agent.db.models import Event as DBEvent # Alias to avoid conflict if EventType.EVENT is used
 from ii_agent.utils.constants import SONNET_4, UPLOAD_FOLDER_NAME, PERSISTENT_DATA_ROOT, PERSISTENT_WORKSPACE_ROOT
 from utils import parse_common_args, create_workspace_manager_for_connection # Assuming utils.py is in PYTHONPATH
 from ii_agent.agents.anthropic_fc import AnthropicFC
 from ii_agent.agents.base import BaseAgent
 from ii_agent.utils import WorkspaceManager
-from ii_agent.llm import get_client
+from ii_agent.llm import LLMClient, get_client
 from ii_agent.llm.context_manager.file_based import FileBasedContextManager
 from ii_agent.llm.context_manager.standard import StandardContextManager
 from ii_agent.llm.token_counter import TokenCounter
-from ii_agent.db.manager import DatabaseManager
 from ii_agent.tools import get_system_tools
 from ii_agent.prompts.system_prompt import SYSTEM_PROMPT
 from ii_agent.utils.pro_utils import extract_pro_key_from_query
 
 
 from .config import app_config # Relative import
+from .common import get_db_manager
 
 logger = logging.getLogger(__name__)
 
@@ -40,16 +46,175 @@ logger = logging.getLogger(__name__)
 MAX_OUTPUT_TOKENS_PER_TURN = 32768 # Or get from config if it becomes configurable
 MAX_TURNS = 200 # Or get from config
 
+# All agents log through one logger (one file handler, one lock) instead of a logger and
+# FileHandler per connection; records carry the connection id from the agent's LoggerAdapter
+AGENT_LOG_FORMAT = "%(asctime)s [%(conn_id)s] %(message)s"
+_agent_logger_lock = threading.Lock()
+_agent_logger_configured = False
+
+# Providers whose clients keep no per-session state, so one client (and its HTTP
+# connection pool) serves every agent with the same settings. The Chutes and OpenRouter
+# clients switch their model_name to whichever fallback model worked, so each agent
+# gets its own.
+SHAREABLE_CLIENT_PROVIDERS = frozenset({"anthropic-direct", "moonshot-direct"})
+
+# Model selection in create_agent_for_connection
+ANTHROPIC_MODELS = frozenset({"claude-3-5-sonnet-20241022", "claude-3-opus-20240229", "claude-3-haiku-20240307", "claude-sonnet-4-0", "claude-opus-4-0"})
+MOONSHOT_MODELS = frozenset({"kimi-k2"})
+PREMIUM_MODELS = frozenset({"claude-sonnet-4-0", "claude-opus-4-0"}) # Pro access only
+PREMIUM_FALLBACK_MODEL = "deepseek-ai/DeepSeek-V3-0324" # Served via Chutes
+MOONSHOT_DEFAULT_MODEL = "claude-opus-4-20250514" # Default model as specified by user
+# Query flags that force a provider, in order of precedence
+PROVIDER_BY_FLAG = (
+    ("use_chutes", "chutes-openai"),
+    ("use_openrouter", "openrouter-openai"),
+    ("use_moonshot", "moonshot-direct"),
+)
+# Provider for a known model id when no flag is set
+PROVIDER_BY_MODEL = {
+    **dict.fromkeys(ANTHROPIC_MODELS, "anthropic-direct"),
+    **dict.fromkeys(MOONSHOT_MODELS, "moonshot-direct"),
+}
+
 # WebSocket connection management
-active_connections: Set[WebSocket] = set()
-connection_timestamps: Dict[WebSocket, datetime] = {}
+@dataclass(slots=True)
+class ConnState:
+    """Server-side state of one accepted WebSocket connection."""
+    ts: float # time.monotonic() when the connection was accepted
+    agent: Optional[BaseAgent] = None
+    task: Optional[asyncio.Task] = None # Agent query task
+    processor: Optional[asyncio.Task] = None # Agent's internal message processing loop
+    workspace_manager: Optional[WorkspaceManager] = None # Set once the workspace is created
+    session_uuid: Optional[uuid.UUID] = None
+
+connections: Dict[WebSocket, ConnState] = {}
 MAX_CONCURRENT_CONNECTIONS = 500 # Or get from config
-active_agents: Dict[WebSocket, BaseAgent] = {}
-active_tasks: Dict[WebSocket, asyncio.Task] = {} # For agent query tasks
-message_processors: Dict[WebSocket, asyncio.Task] = {} # For agent's internal message processing loop
+# (time.monotonic() at accept, weakref to the websocket) in accept order, so the oldest
+# connections are always at the front. Weak so closed connections aren't kept alive.
+connection_ages: Deque[Tuple[float, "weakref.ref[WebSocket]"]] = collections.deque()
+# Connections older than this are closed when a new connection arrives while more than
+# OLD_CONNECTION_EVICTION_THRESHOLD are active; below that, long agent runs are left alone
+VERY_OLD_CONNECTION_SECONDS = 1800
+OLD_CONNECTION_EVICTION_THRESHOLD = 200
+
+# Agent runs (agent.run_agent, blocking) execute in worker threads under their own
+# limiter, so they neither queue behind nor starve anyio's default thread limiter used for
+# other offloaded I/O. A query arriving while all slots are busy is refused, not queued.
+AGENT_WORKERS = int(os.getenv("AGENT_WORKERS", "64"))
+
+@functools.cache
+def get_agent_limiter() -> anyio.CapacityLimiter:
+    """The agent-run limiter, created on first use inside the event loop."""
+    return anyio.CapacityLimiter(AGENT_WORKERS)
+
+# Terminal commands (the bash tool's blocking run_impl) likewise get their own worker
+# threads, so a burst of them can't take every default-limiter thread
+SHELL_WORKERS = int(os.getenv("SHELL_WORKERS", "8"))
+
+@functools.cache
+def get_shell_limiter() -> anyio.CapacityLimiter:
+    """The terminal-command limiter, created on first use inside the event loop."""
+    return anyio.CapacityLimiter(SHELL_WORKERS)
+
+# Seconds between cleanup_stale_connections runs (scheduled by server_setup.lifespan)
+CONNECTION_CLEANUP_INTERVAL_SECONDS = 60
+# With no connections at all the sweep backs off, doubling its interval up to this cap
+CONNECTION_CLEANUP_MAX_IDLE_INTERVAL_SECONDS = 900
+_cleanup_idle_interval = CONNECTION_CLEANUP_INTERVAL_SECONDS
+# The sweep yields to the event loop after this many connections, so a large sweep
+# doesn't hold up websocket traffic
+CLEANUP_YIELD_EVERY = 100
+# A connection that sends nothing for this long is closed (heartbeats are server-to-client)
+RECEIVE_IDLE_TIMEOUT_SECONDS = 300
+
+def make_event(event_type: EventType, content: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    The dict RealtimeEvent(type=event_type, content=content).model_dump() would produce,
+    without building and validating a model, for events the server constructs itself.
+    """
+    return {"type": event_type, "content": content}
+
+
+def error_frame(message: str, error_code: str) -> str:
+    return encode_frame(make_event(EventType.ERROR, {"message": message, "error_code": error_code}))
 
-# This task will be started by the main app's startup event
-periodic_cleanup_task: Optional[asyncio.Task] = None
+
+# Frames whose content never varies, encoded once at import
+HEARTBEAT_FRAME = encode_frame(make_event(EventType.HEARTBEAT, {}))
+PONG_FRAME = encode_frame({"type": "pong"})
+PROCESSING_STARTED_FRAME = encode_frame(make_event(EventType.PROCESSING, {"message": "Query received, processing started."}))
+AGENT_INITIALIZED_FRAME = encode_frame(make_event(EventType.AGENT_INITIALIZED, {"message": "Agent initialized", "server_ready": True})) # server_ready might be redundant here
+AGENT_AUTO_INITIALIZED_FRAME = encode_frame(make_event(EventType.AGENT_INITIALIZED, {"message": "Agent auto-initialized", "server_ready": True}))
+QUERY_CANCELED_FRAME = encode_frame(make_event(EventType.SYSTEM, {"message": "Processing was canceled by the user."})) # Or a more specific CANCELED type
+AGENT_NOT_INITIALIZED_FRAME = error_frame("Agent not initialized for this connection", "AGENT_NOT_INITIALIZED")
+QUERY_IN_PROGRESS_FRAME = error_frame("A query is already being processed", "QUERY_IN_PROGRESS")
+SERVER_BUSY_FRAME = error_frame("The server is busy running other queries, please try again shortly", "SERVER_BUSY")
+NO_ACTIVE_QUERY_FRAME = error_frame("No active query to cancel", "NO_ACTIVE_QUERY")
+MISSING_COMMAND_FRAME = error_frame("Terminal command is required", "MISSING_COMMAND")
+TERMINAL_AGENT_NOT_INITIALIZED_FRAME = error_frame("Agent not initialized for terminal commands", "AGENT_NOT_INITIALIZED")
+BASH_TOOL_UNAVAILABLE_FRAME = error_frame("Terminal functionality is not available", "BASH_TOOL_UNAVAILABLE")
+INVALID_JSON_FRAME = error_frame("Invalid JSON format", "INVALID_JSON")
+
+
+class SingleConsumerQueue:
+    """
+    Stand-in for asyncio.Queue on the agent's event relay, which has exactly one consumer
+    (the agent's message processor). Items go into a plain deque and the consumer waits on
+    a single Future, instead of asyncio.Queue allocating a getter Future per get.
+
+    put_nowait may be called from the agent's worker thread (run_agent runs via
+    anyio.to_thread) as well as from the event loop; the wakeup is then handed to the
+    loop with call_soon_threadsafe.
+    """
+    def __init__(self):
+        self._items: collections.deque = collections.deque()
+        self._waiter: Optional[asyncio.Future] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def qsize(self) -> int:
+        return len(self._items)
+
+    def empty(self) -> bool:
+        return not self._items
+
+    def put_nowait(self, item: Any) -> None:
+        self._items.append(item)
+        if self._waiter is None:
+            return
+        try:
+            in_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError: # No running loop: called from a worker thread
+            in_loop = False
+        if in_loop:
+            self._wake()
+        else:
+            self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        waiter = self._waiter
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    def get_nowait(self) -> Any:
+        if not self._items:
+            raise asyncio.QueueEmpty
+        return self._items.popleft()
+
+    async def get(self) -> Any:
+        while not self._items:
+            self._loop = asyncio.get_running_loop()
+            self._waiter = self._loop.create_future()
+            try:
+                # Re-check after publishing the waiter: a put from another thread between
+                # the emptiness check and here would otherwise not wake us
+                if not self._items:
+                    await self._waiter
+            finally:
+                self._waiter = None
+        return self._items.popleft()
+
+    def task_done(self) -> None:
+        """No-op, kept for asyncio.Queue compatibility (nothing joins the relay)."""
 
 
 async def safe_websocket_send_json(websocket: WebSocket, data: dict, connection_id: Optional[str] = None) -> bool:
@@ -57,21 +222,31 @@ async def safe_websocket_send_json(websocket: WebSocket, data: dict, connection_
     Safely send JSON data over WebSocket with proper error handling.
     Returns True if sent successfully, False otherwise.
     """
+    try:
+        frame = encode_frame(data)
+    except TypeError as e: # orjson.JSONEncodeError
+        logger.error(f"WS_SAFE_SEND ({connection_id or id(websocket)}): Error encoding WebSocket message: {e}")
+        return False
+    return await safe_websocket_send_frame(websocket, frame, connection_id)
+
+
+async def safe_websocket_send_frame(websocket: WebSocket, frame: str, connection_id: Optional[str] = None) -> bool:
+    """safe_websocket_send_json for an already encoded frame (see encode_frame)."""
     if not connection_id:
         connection_id = str(id(websocket))
     
     try:
         # Check if WebSocket is still in a sendable state
-        if websocket.client_state.name == "DISCONNECTED":
-            logger.debug(f"WS_SAFE_SEND ({connection_id}): WebSocket already disconnected, skipping send.")
+        if websocket.client_state is WebSocketState.DISCONNECTED:
+            logger.debug("WS_SAFE_SEND (%s): WebSocket already disconnected, skipping send.", connection_id)
             return False
         
-        await websocket.send_json(data)
+        await websocket.send_text(frame)
         return True
         
     except RuntimeError as e:
         if "Cannot call \"send\" once a close message has been sent" in str(e):
-            logger.debug(f"WS_SAFE_SEND ({connection_id}): WebSocket already closed, skipping send.")
+            logger.debug("WS_SAFE_SEND (%s): WebSocket already closed, skipping send.", connection_id)
         else:
             logger.warning(f"WS_SAFE_SEND ({connection_id}): RuntimeError sending message: {e}")
         return False
@@ -81,55 +256,82 @@ async def safe_websocket_send_json(websocket: WebSocket, data: dict, connection_
         return False
 
 
-def cleanup_connection(websocket: WebSocket):
-    """Clean up resources associated with a websocket connection."""
-    connection_id = id(websocket)
+# Strong references to tasks nobody else holds (the event loop only keeps weak ones), so
+# a fire-and-forget close or a query task already dropped by cleanup_connection can't be
+# garbage collected mid-run
+_bg_tasks: Set[asyncio.Task] = set()
+
+def _spawn(coro: Awaitable[Any]) -> asyncio.Task:
+    """asyncio.create_task, with the task kept referenced until it is done."""
+    task = asyncio.create_task(coro)
+    _bg_tasks.add(task)
+    task.add_done_callback(_bg_tasks.discard)
+    return task
+
+
+@asynccontextmanager
+async def scoped_task(coro: Awaitable[Any]) -> AsyncIterator[asyncio.Task]:
+    """
+    Run coro as a task for the duration of the block, then cancel it and wait for it to
+    finish, however the block exits. A one-child asyncio.TaskGroup (Python 3.11+) for 3.10.
+    """
+    task = asyncio.create_task(coro)
+    try:
+        yield task
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def release_agent(agent: BaseAgent, connection_id: str):
+    """Detach an agent from its websocket and run its own cleanup, if it has one."""
+    logger.info(f"WS_CLEANUP ({connection_id}): Cleaning up agent {type(agent).__name__}.")
+    try:
+        agent.websocket = None # Prevent further sends
+        if hasattr(agent, 'cleanup'): # If agent has a specific cleanup method
+            agent.cleanup()
+            logger.info(f"WS_CLEANUP ({connection_id}): Agent's custom cleanup called.")
+    except Exception as e_agent_cleanup:
+        logger.error(f"WS_CLEANUP ({connection_id}): Error during agent resource cleanup: {e_agent_cleanup}", exc_info=True)
+
+
+def cleanup_connection(websocket: WebSocket, state: Optional[ConnState] = None):
+    """
+    Clean up resources associated with a websocket connection.
+
+    state is the connection's own ConnState, passed by websocket_endpoint so an agent it
+    attached after a sweep already dropped the connection from `connections` is still
+    cleaned up. Cleaning up the same connection twice is harmless.
+    """
+    connection_id = str(id(websocket))
     logger.info(f"WS_CLEANUP ({connection_id}): Starting cleanup.")
     try:
-        if websocket in active_connections:
-            active_connections.remove(websocket)
-            logger.info(f"WS_CLEANUP ({connection_id}): Removed from active_connections.")
-        if websocket in connection_timestamps:
-            del connection_timestamps[websocket]
-            logger.info(f"WS_CLEANUP ({connection_id}): Removed from connection_timestamps.")
-
-        if websocket in active_tasks:
-            task = active_tasks[websocket]
-            if not task.done():
+        state = connections.pop(websocket, None) or state
+        if state is not None:
+            logger.info(f"WS_CLEANUP ({connection_id}): Removed from connections.")
+
+            task, state.task = state.task, None
+            if task is not None and not task.done():
                 logger.info(f"WS_CLEANUP ({connection_id}): Cancelling active query task.")
                 task.cancel()
-            del active_tasks[websocket]
-            logger.info(f"WS_CLEANUP ({connection_id}): Removed from active_tasks.")
 
-        if websocket in message_processors:
-            processor = message_processors[websocket]
-            if not processor.done():
+            processor, state.processor = state.processor, None
+            if processor is not None and not processor.done():
                 logger.info(f"WS_CLEANUP ({connection_id}): Cancelling message processor task.")
                 processor.cancel()
-            del message_processors[websocket]
-            logger.info(f"WS_CLEANUP ({connection_id}): Removed from message_processors.")
 
-        if websocket in active_agents:
-            agent = active_agents[websocket]
-            logger.info(f"WS_CLEANUP ({connection_id}): Cleaning up agent {type(agent).__name__}.")
-            try:
-                agent.websocket = None # Prevent further sends
-                if hasattr(agent, 'cleanup'): # If agent has a specific cleanup method
-                    agent.cleanup()
-                    logger.info(f"WS_CLEANUP ({connection_id}): Agent's custom cleanup called.")
-            except Exception as e_agent_cleanup:
-                logger.error(f"WS_CLEANUP ({connection_id}): Error during agent resource cleanup: {e_agent_cleanup}", exc_info=True)
-            del active_agents[websocket]
-            logger.info(f"WS_CLEANUP ({connection_id}): Removed from active_agents.")
+            agent, state.agent = state.agent, None
+            if agent is not None:
+                release_agent(agent, connection_id)
 
         # Attempt to close WebSocket if not already disconnected
         # This part can be tricky as the state might be hard to determine reliably
         # and closing an already closed/broken socket can raise exceptions.
         try:
-            if websocket.client_state.name != "DISCONNECTED": # Check if client_state exists and is not DISCONNECTED
+            if websocket.client_state is not WebSocketState.DISCONNECTED: # Check if client_state exists and is not DISCONNECTED
                 logger.info(f"WS_CLEANUP ({connection_id}): WebSocket state is {websocket.client_state.name}. Attempting to close.")
                 # Schedule close, don't await, as it might hang if client is unresponsive
-                asyncio.create_task(websocket.close(code=1001)) # 1001: Going Away
+                _spawn(websocket.close(code=1001)) # 1001: Going Away
             else:
                 logger.info(f"WS_CLEANUP ({connection_id}): WebSocket already in DISCONNECTED state.")
         except AttributeError: # websocket.client_state might not exist if connection broke abruptly
@@ -139,7 +341,7 @@ def cleanup_connection(websocket: WebSocket):
         except Exception as e_close:
             logger.error(f"WS_CLEANUP ({connection_id}): Error force closing WebSocket: {e_close}", exc_info=True)
         
-        logger.info(f"WS_CLEANUP ({connection_id}): Cleanup completed. Active connections: {len(active_connections)}")
+        logger.info(f"WS_CLEANUP ({connection_id}): Cleanup completed. Active connections: {len(connections)}")
 
     except Exception as e:
         logger.error(f"WS_CLEANUP ({connection_id}): General error during connection cleanup: {e}", exc_info=True)
@@ -149,19 +351,13 @@ async def run_agent_async(
     websocket: WebSocket, user_input: str, resume: bool = False, files: List[str] = []
 ):
     """Run the agent asynchronously and send results back to the websocket."""
-    agent = active_agents.get(websocket)
-    connection_id = id(websocket)
+    state = connections.get(websocket)
+    agent = state.agent if state is not None else None
+    connection_id = str(id(websocket))
 
     if not agent:
         logger.error(f"AGENT_RUN ({connection_id}): Agent not initialized for this connection.")
-        await safe_websocket_send_json(
-            websocket,
-            RealtimeEvent(
-                type=EventType.ERROR,
-                content={"message": "Agent not initialized for this connection", "error_code": "AGENT_NOT_INITIALIZED"},
-            ).model_dump(),
-            str(connection_id)
-        )
+        await safe_websocket_send_frame(websocket, AGENT_NOT_INITIALIZED_FRAME, connection_id)
         return
 
     logger.info(f"AGENT_RUN ({connection_id}): Starting agent run. Input: '{user_input[:50]}...', Resume: {resume}, Files: {len(files)}")
@@ -175,33 +371,63 @@ async def run_agent_async(
             logger.warning(f"AGENT_RUN ({connection_id}): Agent message_queue not found. User message not queued for DB.")
 
         # Run the agent's main processing logic
-        await anyio.to_thread.run_sync(agent.run_agent, user_input, files, resume)
+        await anyio.to_thread.run_sync(agent.run_agent, user_input, files, resume, limiter=get_agent_limiter())
         logger.info(f"AGENT_RUN ({connection_id}): Agent run completed for input: '{user_input[:50]}...'")
 
     except asyncio.CancelledError:
         logger.info(f"AGENT_RUN ({connection_id}): Agent task was cancelled for input: '{user_input[:50]}...'")
-        await safe_websocket_send_json(
-            websocket,
-            RealtimeEvent(
-                type=EventType.SYSTEM, # Or a more specific CANCELED type
-                content={"message": "Processing was canceled by the user."},
-            ).model_dump(),
-            str(connection_id)
-        )
+        await safe_websocket_send_frame(websocket, QUERY_CANCELED_FRAME, connection_id)
     except Exception as e:
         logger.error(f"AGENT_RUN ({connection_id}): Error running agent: {str(e)}", exc_info=True)
         await safe_websocket_send_json(
             websocket,
-            RealtimeEvent(
-                type=EventType.ERROR,
-                content={"message": f"Error running agent: {str(e)}", "error_code": "AGENT_RUNTIME_ERROR"},
-            ).model_dump(),
-            str(connection_id)
+            make_event(
+                EventType.ERROR,
+                {"message": f"Error running agent: {str(e)}", "error_code": "AGENT_RUNTIME_ERROR"},
+            ),
+            connection_id
         )
     finally:
-        if websocket in active_tasks: # Clean up task reference if it's this one
-            del active_tasks[websocket]
-            logger.debug(f"AGENT_RUN ({connection_id}): Removed task from active_tasks.")
+        if state is not None and state.task is asyncio.current_task(): # Clean up task reference if it's this one
+            state.task = None
+            logger.debug(f"AGENT_RUN ({connection_id}): Cleared connection's query task.")
+
+
+def get_agent_base_logger(app_args) -> logging.Logger:
+    """
+    The "agent_logs" logger all agents write to, each through a LoggerAdapter that adds its
+    connection id. Handlers (the logs_path file, stdout unless minimized) are attached once,
+    on first use; agents are created in worker threads, hence the lock.
+    """
+    global _agent_logger_configured
+    base_logger = logging.getLogger("agent_logs")
+    with _agent_logger_lock:
+        if _agent_logger_configured:
+            return base_logger
+        base_logger.setLevel(logging.DEBUG if not app_args.minimize_stdout_logs else logging.INFO)
+        base_logger.propagate = False # Avoid duplicate logs to root
+        formatter = logging.Formatter(AGENT_LOG_FORMAT)
+        if getattr(app_args, 'logs_path', None):
+            try:
+                # Ensure log directory exists
+                Path(app_args.logs_path).parent.mkdir(parents=True, exist_ok=True)
+                file_handler = logging.FileHandler(app_args.logs_path)
+                file_handler.setFormatter(formatter)
+                base_logger.addHandler(file_handler)
+            except Exception as e_log_handler:
+                logger.error(f"AGENT_CREATE: Failed to set up file handler for agent logger at {app_args.logs_path}: {e_log_handler}")
+        if not app_args.minimize_stdout_logs:
+            stream_handler = logging.StreamHandler() # Add console output if not minimized
+            stream_handler.setFormatter(formatter)
+            base_logger.addHandler(stream_handler)
+        _agent_logger_configured = True
+    return base_logger
+
+
+@functools.lru_cache(maxsize=32)
+def get_shared_client(llm_provider_type: str, client_params: Tuple[Tuple[str, Any], ...]) -> LLMClient:
+    """get_client for a SHAREABLE_CLIENT_PROVIDERS provider, memoized on its settings."""
+    return get_client(llm_provider_type, **dict(client_params))
 
 
 def create_agent_for_connection(
@@ -217,78 +443,46 @@ def create_agent_for_connection(
         logger.error("AGENT_CREATE: Application arguments not set. Cannot create agent.")
         raise ValueError("Application configuration (args) not available.")
 
-    connection_id = id(websocket)
-    device_id = websocket.query_params.get("device_id", "unknown_device")
-    use_chutes_str = websocket.query_params.get("use_chutes", "false")
-    use_chutes = use_chutes_str.lower() == "true"
-    
-    use_openrouter_str = websocket.query_params.get("use_openrouter", "false")
-    use_openrouter = use_openrouter_str.lower() == "true"
-    
-    use_moonshot_str = websocket.query_params.get("use_moonshot", "false")
-    use_moonshot = use_moonshot_str.lower() == "true"
-
-    use_native_tool_calling_str = websocket.query_params.get("use_native_tool_calling", "false")
-    use_native_tool_calling = use_native_tool_calling_str.lower() == "true"
+    connection_id = str(id(websocket))
+    query_params = websocket.query_params
+    device_id = query_params.get("device_id", "unknown_device")
+    use_native_tool_calling = query_params.get("use_native_tool_calling", "false").lower() == "true"
     
-    model_id_param = websocket.query_params.get("model_id", SONNET_4) # Use constant default
+    model_id_param = query_params.get("model_id", SONNET_4) # Use constant default
 
-    pro_key = extract_pro_key_from_query(dict(websocket.query_params))
+    pro_key = extract_pro_key_from_query(dict(query_params))
     has_pro_access = pro_key is not None
     
-    # Model selection logic
-    anthropic_models = ["claude-3-5-sonnet-20241022", "claude-3-opus-20240229", "claude-3-haiku-20240307", "claude-sonnet-4-0", "claude-opus-4-0"]
-    moonshot_models = ["kimi-k2"]
-    is_anthropic_model_selected = model_id_param in anthropic_models
-    is_moonshot_model_selected = model_id_param in moonshot_models
-    
     # Determine provider and final model_id
-    llm_provider_type = "anthropic-direct" # Default
     final_model_id = model_id_param
-
-    if model_id_param in ["claude-sonnet-4-0", "claude-opus-4-0"] and not has_pro_access:
+    if model_id_param in PREMIUM_MODELS and not has_pro_access:
         logger.warning(f"AGENT_CREATE ({connection_id}): Premium model ({model_id_param}) access denied for non-Pro user. Falling back to Chutes/DeepSeek.")
-        final_model_id = "deepseek-ai/DeepSeek-V3-0324" # Fallback model
+        final_model_id = PREMIUM_FALLBACK_MODEL
         llm_provider_type = "chutes-openai" # Fallback provider
         # Ensure native tool calling is sensible for fallback
         # use_native_tool_calling might need to be re-evaluated if fallback model doesn't support it well
-    elif use_chutes:
-        llm_provider_type = "chutes-openai"
-        # final_model_id is already model_id_param
-    elif use_openrouter:
-        llm_provider_type = "openrouter-openai"
-        # final_model_id is already model_id_param
-    elif use_moonshot or is_moonshot_model_selected:
-        llm_provider_type = "moonshot-direct"
-        # For Moonshot, we use the default model they specify
-        final_model_id = "claude-opus-4-20250514"  # Default model as specified by user
-    elif is_anthropic_model_selected:
-        llm_provider_type = "anthropic-direct"
-        # final_model_id is already model_id_param
-    else: # Default case if no specific flags and not an anthropic model by id
-        logger.info(f"AGENT_CREATE ({connection_id}): Defaulting to Chutes provider for model '{model_id_param}'.")
-        llm_provider_type = "chutes-openai" # Or some other sensible default provider for unknown models
-        final_model_id = model_id_param # Keep the user's model_id if possible
-
-    # Setup agent-specific logger
-    agent_logger = logging.getLogger(f"agent_logs_{connection_id}")
-    agent_logger.setLevel(logging.DEBUG if not current_app_args.minimize_stdout_logs else logging.INFO)
-    agent_logger.propagate = False # Avoid duplicate logs to root
-    if not agent_logger.handlers:
-        if hasattr(current_app_args, 'logs_path') and current_app_args.logs_path:
-            try:
-                # Ensure log directory exists
-                log_file_path_obj = Path(current_app_args.logs_path)
-                log_file_path_obj.parent.mkdir(parents=True, exist_ok=True)
-                agent_logger.addHandler(logging.FileHandler(current_app_args.logs_path))
-            except Exception as e_log_handler:
-                logger.error(f"AGENT_CREATE ({connection_id}): Failed to set up file handler for agent logger at {current_app_args.logs_path}: {e_log_handler}")
-        if not current_app_args.minimize_stdout_logs:
-            agent_logger.addHandler(logging.StreamHandler()) # Add console output if not minimized
+    else:
+        # An explicit use_* flag wins, then the provider the model belongs to
+        llm_provider_type = next(
+            (provider for flag, provider in PROVIDER_BY_FLAG if query_params.get(flag, "false").lower() == "true"),
+            None,
+        ) or PROVIDER_BY_MODEL.get(model_id_param)
+        if llm_provider_type == "moonshot-direct":
+            # For Moonshot, we use the default model they specify
+            final_model_id = MOONSHOT_DEFAULT_MODEL
+        elif llm_provider_type is None: # Default case if no specific flags and not a known model id
+            logger.info(f"AGENT_CREATE ({connection_id}): Defaulting to Chutes provider for model '{model_id_param}'.")
+            llm_provider_type = "chutes-openai" # Or some other sensible default provider for unknown models
+
+    # Agent-specific view of the shared agent logger
+    agent_logger = logging.LoggerAdapter(
+        get_agent_base_logger(current_app_args),
+        {"conn_id": connection_id, "session": str(session_uuid)},
+    )
 
     agent_logger.info(f"AGENT_CREATE ({connection_id}): Initializing agent. Provider: {llm_provider_type}, Model: {final_model_id}, Native Tools: {use_native_tool_calling}, Pro: {has_pro_access}")
 
-    db_manager = DatabaseManager()
+    db_manager = get_db_manager()
     # The session_uuid passed in is the one generated by create_workspace_manager_for_connection
     # This should be used to create/retrieve the DB session record.
     actual_db_session_id, actual_workspace_path = db_manager.create_session(
@@ -310,7 +504,10 @@ def create_agent_for_connection(
     elif llm_provider_type == "chutes-openai":
         client_params["use_native_tool_calling"] = use_native_tool_calling
     
-    llm_client = get_client(llm_provider_type, **client_params)
+    if llm_provider_type in SHAREABLE_CLIENT_PROVIDERS:
+        llm_client = get_shared_client(llm_provider_type, tuple(sorted(client_params.items())))
+    else:
+        llm_client = get_client(llm_provider_type, **client_params)
     token_counter = TokenCounter() # Assuming default initialization
 
     context_manager_type = getattr(current_app_args, 'context_manager', "standard")
@@ -323,7 +520,7 @@ def create_agent_for_connection(
             token_counter=token_counter, logger=agent_logger, token_budget=120_000
         )
 
-    message_relay_queue = asyncio.Queue()
+    message_relay_queue = SingleConsumerQueue()
     agent_tools = get_system_tools(
         client=llm_client,
         workspace_manager=workspace_manager,
@@ -355,10 +552,211 @@ def create_agent_for_connection(
     return agent_instance
 
 
+async def create_agent_shielded(
+    session_uuid: uuid.UUID,
+    workspace_manager: WorkspaceManager,
+    websocket: WebSocket,
+    tool_args: Dict[str, Any],
+) -> BaseAgent:
+    """
+    Run create_agent_for_connection in a worker thread, off the event loop, shielded from
+    cancellation of the calling task (e.g. the connection closing mid INIT_AGENT). The DB
+    session record and the agent are always built completely; if the caller was cancelled
+    meanwhile, the agent is released once it exists and the cancellation propagates at once.
+    """
+    connection_id = str(id(websocket))
+    creation = _spawn(anyio.to_thread.run_sync(
+        create_agent_for_connection, session_uuid, workspace_manager, websocket, tool_args
+    ))
+    try:
+        return await asyncio.shield(creation)
+    except asyncio.CancelledError:
+        def release_orphan(done: asyncio.Future):
+            if not done.cancelled() and done.exception() is None:
+                logger.info(f"AGENT_CREATE ({connection_id}): Caller cancelled during agent creation; releasing the new agent.")
+                release_agent(done.result(), connection_id)
+        creation.add_done_callback(release_orphan)
+        raise
+
+
+# Agent -> its bash tool, looked up once per agent rather than on every TERMINAL_COMMAND.
+# Weak so the entry goes away with the agent.
+_bash_tool_cache: "weakref.WeakKeyDictionary[BaseAgent, Any]" = weakref.WeakKeyDictionary()
+
+def get_bash_tool(agent: BaseAgent) -> Optional[Any]:
+    """The agent's bash tool, or None if it has none."""
+    bash_tool = _bash_tool_cache.get(agent)
+    if bash_tool is None:
+        bash_tool = next((tool for tool in agent.tools if tool.name.lower() == 'bash'), None)
+        if bash_tool is not None:
+            _bash_tool_cache[agent] = bash_tool
+    return bash_tool
+
+
+async def _handle_init_agent(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    if state.agent is not None:
+        logger.warning(f"WS_PROCESS ({connection_id}): Agent already initialized. Re-initializing.")
+        # Potentially clean up old agent before creating new one
+        # For now, overwriting, create_agent_for_connection will make a new one
+
+    try:
+        tool_args_param = content.get("tool_args", {})
+        logger.info(f"WS_PROCESS ({connection_id}): Creating agent with tool_args: {tool_args_param}")
+
+        agent = await create_agent_shielded(
+            state.session_uuid, state.workspace_manager, websocket, tool_args_param
+        )
+        logger.info(f"WS_PROCESS ({connection_id}): Agent created successfully")
+
+        state.agent = agent
+        logger.info(f"WS_PROCESS ({connection_id}): Agent attached to connection")
+
+        state.processor = agent.start_message_processing() # Start agent's internal queue processor
+        logger.info(f"WS_PROCESS ({connection_id}): Message processor started")
+
+        await safe_websocket_send_frame(websocket, AGENT_INITIALIZED_FRAME, connection_id)
+        logger.info(f"WS_PROCESS ({connection_id}): AGENT_INITIALIZED response sent")
+
+    except Exception as e_init_agent:
+        logger.error(f"WS_PROCESS ({connection_id}): Error during INIT_AGENT processing: {e_init_agent}", exc_info=True)
+        await safe_websocket_send_json(websocket, make_event(
+            EventType.ERROR,
+            {"message": f"Error initializing agent: {str(e_init_agent)}", "error_code": "AGENT_INIT_ERROR"}
+        ), connection_id)
+
+
+async def _handle_workspace_info_request(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    # This provides info about the specific session's workspace
+    await safe_websocket_send_json(websocket, make_event(
+        EventType.WORKSPACE_INFO,
+        {
+            "workspace_path": str(state.workspace_manager.root), # This session's workspace
+            "session_uuid": str(state.session_uuid),
+            "server_ready": True, # General server status
+            "connection_ready": True # This specific connection is ready
+        }
+    ), connection_id)
+
+
+async def _handle_query(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    if state.task is not None and not state.task.done():
+        logger.warning(f"WS_PROCESS ({connection_id}): Query rejected, another is active.")
+        await safe_websocket_send_frame(websocket, QUERY_IN_PROGRESS_FRAME, connection_id)
+        return
+
+    agent_limiter = get_agent_limiter()
+    if agent_limiter.borrowed_tokens >= agent_limiter.total_tokens:
+        logger.warning(f"WS_PROCESS ({connection_id}): Query rejected, all {AGENT_WORKERS} agent workers busy.")
+        await safe_websocket_send_frame(websocket, SERVER_BUSY_FRAME, connection_id)
+        return
+
+    if state.agent is None: # Auto-initialize if not done explicitly
+        logger.info(f"WS_PROCESS ({connection_id}): Agent not initialized. Auto-initializing.")
+        tool_args_for_auto_init = content.get("tool_args", {})
+        agent = await create_agent_shielded(
+            state.session_uuid, state.workspace_manager, websocket, tool_args_for_auto_init
+        )
+        state.agent = agent
+        state.processor = agent.start_message_processing()
+        await safe_websocket_send_frame(websocket, AGENT_AUTO_INITIALIZED_FRAME, connection_id)
+        await asyncio.sleep(0.1)
+
+    user_input_text = content.get("text", "")
+    resume_flag = content.get("resume", False)
+    files_list = content.get("files", [])
+
+    await safe_websocket_send_frame(websocket, PROCESSING_STARTED_FRAME, connection_id)
+
+    state.task = _spawn(
+        run_agent_async(websocket, user_input_text, resume_flag, files_list)
+    )
+
+
+async def _handle_cancel_processing(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    if state.task is not None and not state.task.done():
+        logger.info(f"WS_PROCESS ({connection_id}): Cancelling active query task upon user request.")
+        state.task.cancel()
+        # run_agent_async's CancelledError handler will send confirmation
+    else:
+        await safe_websocket_send_frame(websocket, NO_ACTIVE_QUERY_FRAME, connection_id)
+
+
+async def _handle_ping(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    # Simple keep-alive from client
+    await safe_websocket_send_frame(websocket, PONG_FRAME, connection_id)
+
+
+async def _handle_terminal_command(websocket: WebSocket, connection_id: str, state: ConnState, content: Dict[str, Any]):
+    command = content.get("command")
+    if not command:
+        logger.error(f"WS_PROCESS ({connection_id}): No command provided for TERMINAL_COMMAND.")
+        await safe_websocket_send_frame(websocket, MISSING_COMMAND_FRAME, connection_id)
+        return
+
+    if state.agent is None:
+        logger.error(f"WS_PROCESS ({connection_id}): Agent not initialized for TERMINAL_COMMAND.")
+        await safe_websocket_send_frame(websocket, TERMINAL_AGENT_NOT_INITIALIZED_FRAME, connection_id)
+        return
+
+    bash_tool = get_bash_tool(state.agent)
+
+    if not bash_tool:
+        logger.error(f"WS_PROCESS ({connection_id}): Bash tool not found in agent's tools.")
+        await safe_websocket_send_frame(websocket, BASH_TOOL_UNAVAILABLE_FRAME, connection_id)
+        return
+
+    logger.info(f"WS_PROCESS ({connection_id}): Executing terminal command via agent's bash tool: {command}")
+
+    try:
+        # The tool's run method might be async or sync. We assume it can be awaited.
+        # If run_impl is synchronous, it should be wrapped with to_thread.run_sync
+        # Based on tool definition, it seems to be sync. Let's stick to that.
+        result = await anyio.to_thread.run_sync(
+            bash_tool.run_impl, {"command": command}, limiter=get_shell_limiter()
+        )
+
+        output_content = result.output if hasattr(result, 'output') else str(result)
+
+        await safe_websocket_send_json(websocket, make_event(
+            EventType.TERMINAL_OUTPUT,
+            {
+                "command": command,
+                "output": output_content,
+                "success": True # Assuming run_impl would raise exception on failure
+            }
+        ), connection_id)
+
+    except Exception as e_terminal:
+        logger.error(f"WS_PROCESS ({connection_id}): Error executing terminal command '{command}': {e_terminal}", exc_info=True)
+        await safe_websocket_send_json(websocket, make_event(
+            EventType.TERMINAL_OUTPUT,
+            {
+                "command": command,
+                "output": f"Error: {str(e_terminal)}",
+                "success": False
+            }
+        ), connection_id)
+
+
+MessageHandler = Callable[[WebSocket, str, ConnState, Dict[str, Any]], Awaitable[None]]
+
+# Inbound message type -> handler, keyed by the plain type strings so dispatch is one dict
+# lookup on the decoded "type" value
+HANDLERS: Dict[str, MessageHandler] = {
+    EventType.INIT_AGENT.value: _handle_init_agent,
+    EventType.WORKSPACE_INFO_REQUEST.value: _handle_workspace_info_request,
+    EventType.QUERY.value: _handle_query,
+    EventType.USER_MESSAGE.value: _handle_query, # Treated as a QUERY
+    EventType.CANCEL_PROCESSING.value: _handle_cancel_processing,
+    EventType.PING.value: _handle_ping,
+    EventType.TERMINAL_COMMAND.value: _handle_terminal_command,
+}
+
+
 async def websocket_endpoint(websocket: WebSocket):
     """WebSocket endpoint for real-time communication with the client."""
     client_ip = websocket.client.host if websocket.client else "unknown_ip"
-    connection_id = id(websocket)
+    connection_id = str(id(websocket)) # Formatted once, not per send
     logger.info(f"WS_ENDPOINT ({connection_id}): New connection attempt from {client_ip}.")
 
     try:
@@ -375,77 +773,85 @@ async def websocket_endpoint(websocket: WebSocket):
             pass
         return
 
-    if len(active_connections) >= MAX_CONCURRENT_CONNECTIONS:
+    if len(connections) >= MAX_CONCURRENT_CONNECTIONS:
         logger.warning(f"WS_ENDPOINT ({connection_id}): Connection limit ({MAX_CONCURRENT_CONNECTIONS}) reached. Rejecting.")
         await websocket.close(code=1013, reason="Server overloaded") # Try again later
         return
     
-    # Simple periodic cleanup of very old connections if many are active
-    if len(active_connections) > 200: # Threshold for this specific check
-        logger.info(f"WS_ENDPOINT ({connection_id}): Active connections ({len(active_connections)}) > 200, checking for very old connections.")
-        current_time_utc = datetime.utcnow()
-        old_connections_to_gc = [
-            ws for ws, ts in list(connection_timestamps.items()) # Iterate over a copy
-            if (current_time_utc - ts).total_seconds() > 1800 # 30 minutes
-        ]
-        for ws_old in old_connections_to_gc:
-            old_conn_id = id(ws_old)
-            logger.info(f"WS_ENDPOINT ({connection_id}): Cleaning up very old connection {old_conn_id} (older than 30 mins).")
-            cleanup_connection(ws_old) # This handles internal state
-            try:
-                await ws_old.close(code=1001, reason="Connection idle too long")
-            except Exception: pass # Might already be closed
-        if old_connections_to_gc:
-            logger.info(f"WS_ENDPOINT ({connection_id}): Cleaned up {len(old_connections_to_gc)} very old connections.")
-
-    heartbeat_task_local = None # Define before try block
+    # Close very old connections as new ones arrive, under load only. connection_ages is in
+    # age order, so only its front is looked at rather than every connection; entries of
+    # connections already gone are dropped either way.
+    now = time.monotonic()
+    old_connections_closed = 0
+    while connection_ages and now - connection_ages[0][0] > VERY_OLD_CONNECTION_SECONDS:
+        ws_old = connection_ages[0][1]()
+        if ws_old is None or ws_old not in connections: # Already gone
+            connection_ages.popleft()
+            continue
+        if len(connections) <= OLD_CONNECTION_EVICTION_THRESHOLD:
+            break
+        connection_ages.popleft()
+        logger.info(f"WS_ENDPOINT ({connection_id}): Cleaning up very old connection {id(ws_old)} (older than 30 mins).")
+        cleanup_connection(ws_old) # This handles internal state
+        try:
+            await ws_old.close(code=1001, reason="Connection idle too long")
+        except Exception: pass # Might already be closed
+        old_connections_closed += 1
+    if old_connections_closed:
+        logger.info(f"WS_ENDPOINT ({connection_id}): Cleaned up {old_connections_closed} very old connections.")
+
+    conn_state: Optional[ConnState] = None
+    idle_timer: Optional[asyncio.TimerHandle] = None
     try:
         await websocket.accept()
-        active_connections.add(websocket)
-        connection_timestamps[websocket] = datetime.utcnow()
-        logger.info(f"WS_ENDPOINT ({connection_id}): Connection accepted from {client_ip}. Active: {len(active_connections)}")
+        conn_state = ConnState(ts=time.monotonic())
+        connections[websocket] = conn_state
+        connection_ages.append((conn_state.ts, weakref.ref(websocket)))
+        logger.info(f"WS_ENDPOINT ({connection_id}): Connection accepted from {client_ip}. Active: {len(connections)}")
 
         try:
             ws_creation_start_time = time.time()
             # workspace_scope can be 'persistent' or 'session' based on args
             # use_container_workspace also from args
-            workspace_manager, session_uuid_for_connection = create_workspace_manager_for_connection(
-                workspace_root=current_app_args.workspace, # From global args
-                use_container_workspace=current_app_args.use_container_workspace # From global args
+            # mkdir on the (possibly network-backed) workspace disk; kept off the event loop
+            # like agent creation
+            workspace_manager, session_uuid_for_connection = await anyio.to_thread.run_sync(
+                create_workspace_manager_for_connection,
+                current_app_args.workspace, # From global args
+                current_app_args.use_container_workspace, # From global args
             )
+            conn_state.workspace_manager = workspace_manager
+            conn_state.session_uuid = session_uuid_for_connection
             logger.info(f"WS_ENDPOINT ({connection_id}): Workspace manager created in {time.time() - ws_creation_start_time:.3f}s. Session UUID: {session_uuid_for_connection}, Root: {workspace_manager.root}")
         except Exception as e:
             logger.error(f"WS_ENDPOINT ({connection_id}): Error creating workspace manager: {e}", exc_info=True)
-            await safe_websocket_send_json(websocket, RealtimeEvent(
-                type=EventType.ERROR,
-                content={"message": f"Error creating workspace: {str(e)}", "error_code": "WORKSPACE_CREATION_ERROR"}
-            ).model_dump(), str(connection_id))
+            await safe_websocket_send_json(websocket, make_event(
+                EventType.ERROR,
+                {"message": f"Error creating workspace: {str(e)}", "error_code": "WORKSPACE_CREATION_ERROR"}
+            ), connection_id)
             return
 
-        await safe_websocket_send_json(websocket, RealtimeEvent(
-            type=EventType.CONNECTION_ESTABLISHED,
-            content={
+        await safe_websocket_send_json(websocket, make_event(
+            EventType.CONNECTION_ESTABLISHED,
+            {
                 "message": "Connected to Agent WebSocket Server",
                 "workspace_path": str(workspace_manager.root), # Path of this specific session's workspace
-                "connection_id": str(connection_id),
+                "connection_id": connection_id,
                 "session_uuid": str(session_uuid_for_connection), # Send the unique session UUID
-                "active_connections": len(active_connections),
+                "active_connections": len(connections),
                 "server_ready": True,
             },
-        ).model_dump(), str(connection_id))
+        ), connection_id)
 
         async def heartbeat_sender():
             try:
                 while True:
                     await asyncio.sleep(30)
-                    if websocket.client_state.name == "DISCONNECTED": 
+                    if websocket.client_state is WebSocketState.DISCONNECTED: 
                         logger.debug(f"WS_HEARTBEAT ({connection_id}): WebSocket disconnected, stopping heartbeat.")
                         break
                     # FastAPI WebSocket doesn't have a ping method, so we send a custom ping message
-                    success = await safe_websocket_send_json(websocket, RealtimeEvent(
-                        type=EventType.HEARTBEAT,
-                        content={}
-                    ).model_dump(), str(connection_id))
+                    success = await safe_websocket_send_frame(websocket, HEARTBEAT_FRAME, connection_id)
                     if not success:
                         logger.debug(f"WS_HEARTBEAT ({connection_id}): Failed to send heartbeat, stopping.")
                         break
@@ -456,206 +862,63 @@ async def websocket_endpoint(websocket: WebSocket):
                 # Don't call cleanup_connection here as it creates race conditions
                 # Just stop the heartbeat and let the main loop handle cleanup
 
-        heartbeat_task_local = asyncio.create_task(heartbeat_sender())
-
-        while True:
-            try:
-                raw_data = await asyncio.wait_for(websocket.receive_text(), timeout=300.0) # 5 min read timeout
-                logger.debug(f"WS_RECEIVE ({connection_id}): Received raw data (len: {len(raw_data)}): {raw_data[:100]}...")
-            except asyncio.TimeoutError:
-                logger.warning(f"WS_RECEIVE ({connection_id}): Timeout waiting for message. Closing.")
-                break # Goes to finally, then cleanup
-            except WebSocketDisconnect as e_disconnect: # Handle explicit disconnect type
-                logger.info(f"WS_RECEIVE ({connection_id}): WebSocketDisconnect received (code: {e_disconnect.code}, reason: '{e_disconnect.reason}').")
-                break # Goes to finally, then cleanup
-            except Exception as e_recv: # Other receive errors
-                logger.error(f"WS_RECEIVE ({connection_id}): Error receiving message: {e_recv}. State: {websocket.client_state.name if hasattr(websocket, 'client_state') else 'unknown'}", exc_info=True)
-                break # Goes to finally, then cleanup
+        # The heartbeat lives exactly as long as the receive loop below
+        async with scoped_task(heartbeat_sender()):
+            # Read timeout: one timer per connection that re-arms itself for the remaining idle
+            # time, rather than an asyncio.wait_for (timer + wrapper) around every receive.
+            # Closing the socket makes the pending receive_text raise, which ends the loop.
+            loop = asyncio.get_running_loop()
+            last_recv_ts = loop.time()
+
+            def idle_check():
+                nonlocal idle_timer
+                idle_seconds = loop.time() - last_recv_ts
+                if idle_seconds >= RECEIVE_IDLE_TIMEOUT_SECONDS:
+                    logger.warning(f"WS_RECEIVE ({connection_id}): No message for {idle_seconds:.0f}s. Closing.")
+                    idle_timer = None
+                    _spawn(websocket.close(code=1001)) # 1001: Going Away
+                else:
+                    idle_timer = loop.call_later(RECEIVE_IDLE_TIMEOUT_SECONDS - idle_seconds, idle_check)
+
+            idle_timer = loop.call_later(RECEIVE_IDLE_TIMEOUT_SECONDS, idle_check)
+
+            while True:
+                try:
+                    raw_data = await websocket.receive_text()
+                    last_recv_ts = loop.time()
+                    if logger.isEnabledFor(logging.DEBUG): # Skip the slice and formatting per message
+                        logger.debug(f"WS_RECEIVE ({connection_id}): Received raw data (len: {len(raw_data)}): {raw_data[:100]}...")
+                except WebSocketDisconnect as e_disconnect: # Handle explicit disconnect type
+                    logger.info(f"WS_RECEIVE ({connection_id}): WebSocketDisconnect received (code: {e_disconnect.code}, reason: '{e_disconnect.reason}').")
+                    break # Goes to finally, then cleanup
+                except Exception as e_recv: # Other receive errors
+                    logger.error(f"WS_RECEIVE ({connection_id}): Error receiving message: {e_recv}. State: {getattr(getattr(websocket, 'client_state', None), 'name', 'unknown')}", exc_info=True)
+                    break # Goes to finally, then cleanup
             
-            try:
-                message_json = json.loads(raw_data)
-                msg_type = message_json.get("type")
-                content = message_json.get("content", {})
-                logger.info(f"WS_PROCESS ({connection_id}): Processing message type '{msg_type}'.")
-
-                if msg_type == EventType.INIT_AGENT.value: # Compare with Enum.value
-                    if websocket in active_agents:
-                        logger.warning(f"WS_PROCESS ({connection_id}): Agent already initialized. Re-initializing.")
-                        # Potentially clean up old agent before creating new one
-                        # For now, overwriting, create_agent_for_connection will make a new one
-                    
-                    try:
-                        tool_args_param = content.get("tool_args", {})
-                        logger.info(f"WS_PROCESS ({connection_id}): Creating agent with tool_args: {tool_args_param}")
-                        
-                        agent = create_agent_for_connection(
-                            session_uuid_for_connection, workspace_manager, websocket, tool_args_param
-                        )
-                        logger.info(f"WS_PROCESS ({connection_id}): Agent created successfully")
-                        
-                        active_agents[websocket] = agent
-                        logger.info(f"WS_PROCESS ({connection_id}): Agent added to active_agents")
-                        
-                        message_processors[websocket] = agent.start_message_processing() # Start agent's internal queue processor
-                        logger.info(f"WS_PROCESS ({connection_id}): Message processor started")
-                        
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.AGENT_INITIALIZED,
-                            content={"message": "Agent initialized", "server_ready": True} # server_ready might be redundant here
-                        ).model_dump(), str(connection_id))
-                        logger.info(f"WS_PROCESS ({connection_id}): AGENT_INITIALIZED response sent")
-                        
-                    except Exception as e_init_agent:
-                        logger.error(f"WS_PROCESS ({connection_id}): Error during INIT_AGENT processing: {e_init_agent}", exc_info=True)
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": f"Error initializing agent: {str(e_init_agent)}", "error_code": "AGENT_INIT_ERROR"}
-                        ).model_dump(), str(connection_id))
-                        continue
-
-                elif msg_type == EventType.WORKSPACE_INFO_REQUEST.value: # Assuming an enum value for this
-                    # This provides info about the specific session's workspace
-                    await safe_websocket_send_json(websocket, RealtimeEvent(
-                        type=EventType.WORKSPACE_INFO,
-                        content={
-                            "workspace_path": str(workspace_manager.root), # This session's workspace
-                            "session_uuid": str(session_uuid_for_connection),
-                            "server_ready": True, # General server status
-                            "connection_ready": True # This specific connection is ready
-                        }
-                    ).model_dump(), str(connection_id))
-                
-                elif msg_type in [EventType.QUERY.value, EventType.USER_MESSAGE.value]:
-                    logger.info(f"WS_PROCESS ({connection_id}): Received {msg_type}, treating as QUERY.")
-                    if websocket in active_tasks and not active_tasks[websocket].done():
-                        logger.warning(f"WS_PROCESS ({connection_id}): Query rejected, another is active.")
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": "A query is already being processed", "error_code": "QUERY_IN_PROGRESS"}
-                        ).model_dump(), str(connection_id))
-                        continue
-
-                    if websocket not in active_agents: # Auto-initialize if not done explicitly
-                        logger.info(f"WS_PROCESS ({connection_id}): Agent not initialized. Auto-initializing.")
-                        tool_args_for_auto_init = content.get("tool_args", {})
-                        agent = create_agent_for_connection(
-                            session_uuid_for_connection, workspace_manager, websocket, tool_args_for_auto_init
-                        )
-                        active_agents[websocket] = agent
-                        message_processors[websocket] = agent.start_message_processing()
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.AGENT_INITIALIZED,
-                            content={"message": "Agent auto-initialized", "server_ready": True}
-                        ).model_dump(), str(connection_id))
-                        await asyncio.sleep(0.1)
-
-                    user_input_text = content.get("text", "")
-                    resume_flag = content.get("resume", False)
-                    files_list = content.get("files", [])
-                    
-                    await safe_websocket_send_json(websocket, RealtimeEvent(
-                        type=EventType.PROCESSING,
-                        content={"message": "Query received, processing started."}
-                    ).model_dump(), str(connection_id))
-
-                    agent_task = asyncio.create_task(
-                        run_agent_async(websocket, user_input_text, resume_flag, files_list)
-                    )
-                    active_tasks[websocket] = agent_task
-                
-                elif msg_type == EventType.CANCEL_PROCESSING.value: # Assuming an enum value
-                    if websocket in active_tasks and not active_tasks[websocket].done():
-                        logger.info(f"WS_PROCESS ({connection_id}): Cancelling active query task upon user request.")
-                        active_tasks[websocket].cancel()
-                        # run_agent_async's CancelledError handler will send confirmation
-                    else:
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": "No active query to cancel", "error_code": "NO_ACTIVE_QUERY"}
-                        ).model_dump(), str(connection_id))
-                
-                elif msg_type == EventType.PING.value: # Simple keep-alive from client
-                    await safe_websocket_send_json(websocket, {"type": "pong"}, str(connection_id))
-
-                elif msg_type == EventType.TERMINAL_COMMAND.value:
+                try:
+                    message_json = orjson.loads(raw_data)
+                    msg_type = message_json.get("type")
                     content = message_json.get("content", {})
-                    command = content.get("command")
-                    if not command:
-                        logger.error(f"WS_PROCESS ({connection_id}): No command provided for TERMINAL_COMMAND.")
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": "Terminal command is required", "error_code": "MISSING_COMMAND"}
-                        ).model_dump(), str(connection_id))
-                        continue
-
-                    if websocket not in active_agents:
-                        logger.error(f"WS_PROCESS ({connection_id}): Agent not initialized for TERMINAL_COMMAND.")
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": "Agent not initialized for terminal commands", "error_code": "AGENT_NOT_INITIALIZED"}
-                        ).model_dump(), str(connection_id))
-                        continue
-
-                    agent = active_agents[websocket]
-                    bash_tool = next((tool for tool in agent.tools if tool.name.lower() == 'bash'), None)
-
-                    if not bash_tool:
-                        logger.error(f"WS_PROCESS ({connection_id}): Bash tool not found in agent's tools.")
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.ERROR,
-                            content={"message": "Terminal functionality is not available", "error_code": "BASH_TOOL_UNAVAILABLE"}
-                        ).model_dump(), str(connection_id))
-                        continue
-                    
-                    logger.info(f"WS_PROCESS ({connection_id}): Executing terminal command via agent's bash tool: {command}")
-                    
-                    try:
-                        # The tool's run method might be async or sync. We assume it can be awaited.
-                        # If run_impl is synchronous, it should be wrapped with to_thread.run_sync
-                        # Based on tool definition, it seems to be sync. Let's stick to that.
-                        result = await anyio.to_thread.run_sync(
-                            bash_tool.run_impl, {"command": command}
-                        )
-                        
-                        output_content = result.output if hasattr(result, 'output') else str(result)
-                        
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.TERMINAL_OUTPUT,
-                            content={
-                                "command": command,
-                                "output": output_content,
-                                "success": True # Assuming run_impl would raise exception on failure
-                            }
-                        ).model_dump(), str(connection_id))
-                        
-                    except Exception as e_terminal:
-                        logger.error(f"WS_PROCESS ({connection_id}): Error executing terminal command '{command}': {e_terminal}", exc_info=True)
-                        await safe_websocket_send_json(websocket, RealtimeEvent(
-                            type=EventType.TERMINAL_OUTPUT,
-                            content={
-                                "command": command,
-                                "output": f"Error: {str(e_terminal)}",
-                                "success": False
-                            }
-                        ).model_dump(), str(connection_id))
+                    logger.info("WS_PROCESS (%s): Processing message type '%s'.", connection_id, msg_type)
+
+                    handler = HANDLERS.get(msg_type)
+                    if handler is None:
+                        logger.warning(f"WS_PROCESS ({connection_id}): Unknown message type '{msg_type}'.")
+                        await safe_websocket_send_json(websocket, make_event(
+                            EventType.ERROR,
+                            {"message": f"Unknown message type: {msg_type}", "error_code": "UNKNOWN_MESSAGE_TYPE"}
+                        ), connection_id)
+                    else:
+                        await handler(websocket, connection_id, conn_state, content)
 
-                else:
-                    logger.warning(f"WS_PROCESS ({connection_id}): Unknown message type '{msg_type}'.")
-                    await safe_websocket_send_json(websocket, RealtimeEvent(
-                        type=EventType.ERROR,
-                        content={"message": f"Unknown message type: {msg_type}", "error_code": "UNKNOWN_MESSAGE_TYPE"}
-                    ).model_dump(), str(connection_id))
-
-            except json.JSONDecodeError:
-                logger.error(f"WS_PROCESS ({connection_id}): Invalid JSON received: {raw_data[:200]}...")
-                await safe_websocket_send_json(websocket, RealtimeEvent(
-                    type=EventType.ERROR, content={"message": "Invalid JSON format", "error_code": "INVALID_JSON"}
-                ).model_dump(), str(connection_id))
-            except Exception as e_process_msg:
-                logger.error(f"WS_PROCESS ({connection_id}): Error processing message: {e_process_msg}", exc_info=True)
-                await safe_websocket_send_json(websocket, RealtimeEvent(
-                    type=EventType.ERROR, content={"message": f"Error processing request: {str(e_process_msg)}", "error_code": "MESSAGE_PROCESSING_ERROR"}
-                ).model_dump(), str(connection_id))
+                except orjson.JSONDecodeError:
+                    logger.error(f"WS_PROCESS ({connection_id}): Invalid JSON received: {raw_data[:200]}...")
+                    await safe_websocket_send_frame(websocket, INVALID_JSON_FRAME, connection_id)
+                except Exception as e_process_msg:
+                    logger.error(f"WS_PROCESS ({connection_id}): Error processing message: {e_process_msg}", exc_info=True)
+                    await safe_websocket_send_json(websocket, make_event(
+                        EventType.ERROR, {"message": f"Error processing request: {str(e_process_msg)}", "error_code": "MESSAGE_PROCESSING_ERROR"}
+                    ), connection_id)
 
     except WebSocketDisconnect as e_main_disconnect: # Catch disconnect at the outer loop too
         logger.info(f"WS_ENDPOINT ({connection_id}): WebSocket disconnected (code: {e_main_disconnect.code}, reason: '{e_main_disconnect.reason}') from {client_ip}.")
@@ -663,86 +926,80 @@ async def websocket_endpoint(websocket: WebSocket):
         logger.error(f"WS_ENDPOINT ({connection_id}): Unhandled WebSocket error from {client_ip}: {e_main}", exc_info=True)
         # Try to close gracefully if possible
         try:
-            if websocket.client_state.name != "DISCONNECTED":
+            if websocket.client_state is not WebSocketState.DISCONNECTED:
                 await websocket.close(code=1011) # Internal server error
         except Exception: pass # Ignore errors during this emergency close
     finally:
         logger.info(f"WS_ENDPOINT ({connection_id}): Finalizing connection from {client_ip}.")
-        if heartbeat_task_local and not heartbeat_task_local.done():
-            heartbeat_task_local.cancel()
-            logger.debug(f"WS_ENDPOINT ({connection_id}): Heartbeat task cancelled.")
-        cleanup_connection(websocket) # Ensure cleanup is always called
-
-
-async def periodic_connection_cleanup_task():
-    """Periodically cleans up stale WebSocket connections."""
-    logger.info("PERIODIC_CLEANUP_TASK: Started.")
-    while True:
-        await asyncio.sleep(60) # Run every minute
-        logger.debug(f"PERIODIC_CLEANUP_TASK: Running check. Active connections: {len(active_connections)}")
-        
-        stale_ws_connections = []
-        current_time_utc = datetime.utcnow()
+        if idle_timer is not None:
+            idle_timer.cancel()
+        cleanup_connection(websocket, conn_state) # Ensure cleanup is always called
 
-        # Iterate over a copy of active_connections set for safe removal
-        for ws_conn in list(active_connections):
-            conn_id = id(ws_conn)
-            try:
-                # Check 1: WebSocket state is DISCONNECTED (e.g., client closed abruptly)
-                if ws_conn.client_state.name == "DISCONNECTED":
-                    logger.info(f"PERIODIC_CLEANUP_TASK: Found stale connection {conn_id} (state: DISCONNECTED).")
-                    stale_ws_connections.append(ws_conn)
-                    continue # Move to next connection
-
-                # Check 2: Connection is very old (e.g., > 1 hour) - a safety net
-                if ws_conn in connection_timestamps:
-                    age_seconds = (current_time_utc - connection_timestamps[ws_conn]).total_seconds()
-                    if age_seconds > 3600: # 1 hour
-                        logger.info(f"PERIODIC_CLEANUP_TASK: Found very old connection {conn_id} (age: {age_seconds/60:.1f} mins). Marking for cleanup.")
-                        stale_ws_connections.append(ws_conn)
-                        # Try to close it politely first
-                        try: await ws_conn.close(code=1001, reason="Extended inactivity")
-                        except: pass
-                
-                # Check 3: Ping failure might have already triggered cleanup, but double check if task is still there but agent gone
-                if ws_conn not in active_agents and ws_conn not in active_tasks:
-                    logger.info(f"PERIODIC_CLEANUP_TASK: Found connection {conn_id} with no associated agent or task. Marking for cleanup.")
-                    stale_ws_connections.append(ws_conn)
-
-
-            except AttributeError: # client_state might not exist if connection broke very badly
-                 logger.warning(f"PERIODIC_CLEANUP_TASK: Connection {conn_id} missing client_state, likely broken. Marking stale.")
-                 stale_ws_connections.append(ws_conn)
-            except Exception as e_check: # Catch-all for errors during check phase for a single connection
-                logger.error(f"PERIODIC_CLEANUP_TASK: Error checking connection {conn_id}: {e_check}. Marking stale as precaution.", exc_info=True)
-                stale_ws_connections.append(ws_conn)
-        
-        if stale_ws_connections:
-            logger.info(f"PERIODIC_CLEANUP_TASK: Found {len(stale_ws_connections)} stale connections to process.")
-            for ws_stale in stale_ws_connections:
-                stale_id = id(ws_stale)
-                logger.info(f"PERIODIC_CLEANUP_TASK: Processing cleanup for stale connection {stale_id}.")
-                cleanup_connection(ws_stale) # This handles all internal state removal
-                # The close attempt is now part of cleanup_connection or handled by WebSocketDisconnect
-            logger.info(f"PERIODIC_CLEANUP_TASK: Finished processing stale connections. Active now: {len(active_connections)}")
-        else:
-            logger.debug("PERIODIC_CLEANUP_TASK: No stale connections found in this cycle.")
-
-def start_periodic_cleanup():
-    """Starts the periodic cleanup task."""
-    global periodic_cleanup_task
-    if periodic_cleanup_task is None or periodic_cleanup_task.done():
-        periodic_cleanup_task = asyncio.create_task(periodic_connection_cleanup_task())
-        logger.info("Periodic connection cleanup task started.")
-    else:
-        logger.info("Periodic connection cleanup task already running.")
-
-def stop_periodic_cleanup():
-    """Stops the periodic cleanup task if running."""
-    global periodic_cleanup_task
-    if periodic_cleanup_task and not periodic_cleanup_task.done():
-        periodic_cleanup_task.cancel()
-        logger.info("Periodic connection cleanup task cancellation requested.")
-        periodic_cleanup_task = None
+
+async def cleanup_stale_connections() -> Optional[float]:
+    """
+    Cleans up stale WebSocket connections in one pass. Run every
+    CONNECTION_CLEANUP_INTERVAL_SECONDS by the background task scheduler (see server_setup.lifespan),
+    less often while there are no connections: returns the delay until the next run then.
+    """
+    global _cleanup_idle_interval
+    if not connections:
+        _cleanup_idle_interval = min(_cleanup_idle_interval * 2, CONNECTION_CLEANUP_MAX_IDLE_INTERVAL_SECONDS)
+        return _cleanup_idle_interval
+    _cleanup_idle_interval = CONNECTION_CLEANUP_INTERVAL_SECONDS
+
+    logger.debug("PERIODIC_CLEANUP_TASK: Running check. Active connections: %d", len(connections))
+    
+    # Sets, since one connection can fail more than one check below
+    stale_ws_connections = set()
+    very_old_connections = set() # Subset of the above, closed politely before cleanup
+    now = time.monotonic()
+    disconnected = WebSocketState.DISCONNECTED # Looked up once, not per connection
+
+    # Nothing in this pass awaits or mutates, so connections is iterated directly instead
+    # of copied; closing and cleanup happen in the second pass
+    for ws_conn, conn_state in connections.items():
+        conn_id = id(ws_conn)
+        try:
+            # Check 1: WebSocket state is DISCONNECTED (e.g., client closed abruptly)
+            if ws_conn.client_state is disconnected:
+                logger.info(f"PERIODIC_CLEANUP_TASK: Found stale connection {conn_id} (state: DISCONNECTED).")
+                stale_ws_connections.add(ws_conn)
+                continue # Move to next connection
+
+            # Check 2: Connection is very old (e.g., > 1 hour) - a safety net
+            age_seconds = now - conn_state.ts
+            if age_seconds > 3600: # 1 hour
+                logger.info(f"PERIODIC_CLEANUP_TASK: Found very old connection {conn_id} (age: {age_seconds/60:.1f} mins). Marking for cleanup.")
+                stale_ws_connections.add(ws_conn)
+                very_old_connections.add(ws_conn)
+            
+            # Check 3: Ping failure might have already triggered cleanup, but double check if task is still there but agent gone
+            if conn_state.agent is None and conn_state.task is None:
+                logger.info(f"PERIODIC_CLEANUP_TASK: Found connection {conn_id} with no associated agent or task. Marking for cleanup.")
+                stale_ws_connections.add(ws_conn)
+
+
+        except AttributeError: # client_state might not exist if connection broke very badly
+             logger.warning(f"PERIODIC_CLEANUP_TASK: Connection {conn_id} missing client_state, likely broken. Marking stale.")
+             stale_ws_connections.add(ws_conn)
+        except Exception as e_check: # Catch-all for errors during check phase for a single connection
+            logger.error(f"PERIODIC_CLEANUP_TASK: Error checking connection {conn_id}: {e_check}. Marking stale as precaution.", exc_info=True)
+            stale_ws_connections.add(ws_conn)
+    
+    if stale_ws_connections:
+        logger.info(f"PERIODIC_CLEANUP_TASK: Found {len(stale_ws_connections)} stale connections to process.")
+        for index, ws_stale in enumerate(stale_ws_connections, 1):
+            if index % CLEANUP_YIELD_EVERY == 0:
+                await asyncio.sleep(0)
+            stale_id = id(ws_stale)
+            logger.info(f"PERIODIC_CLEANUP_TASK: Processing cleanup for stale connection {stale_id}.")
+            if ws_stale in very_old_connections:
+                # Try to close it politely first
+                try: await ws_stale.close(code=1001, reason="Extended inactivity")
+                except: pass
+            cleanup_connection(ws_stale) # This handles all internal state removal
+            # The close attempt is now part of cleanup_connection or handled by WebSocketDisconnect
+        logger.info(f"PERIODIC_CLEANUP_TASK: Finished processing stale connections. Active now: {len(connections)}")
     else:
-        logger.info("Periodic connection cleanup task not running or already stopped.")
+        logger.debug("PERIODIC_CLEANUP_TASK: No stale connections found in this cycle.")
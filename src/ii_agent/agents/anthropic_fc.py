@@ -7,7 +7,7 @@ import os
 from typing import List
 from fastapi import WebSocket
 from ii_agent.agents.base import BaseAgent
-from ii_agent.core.event import EventType, RealtimeEvent
+from ii_agent.core.event import EventType, RealtimeEvent, encode_frame
 from ii_agent.llm.base import LLMClient, TextResult
 from ii_agent.llm.context_manager.base import ContextManager
 from ii_agent.llm.message_history import MessageHistory
@@ -38,6 +38,8 @@ try breaking down the task into smaller steps. After call this tool to update or
         "required": ["instruction"],
     }
     websocket: Optional[WebSocket]
+    # Upper bound on the events coalesced into one websocket frame
+    MAX_EVENTS_PER_FRAME = 64
 
     def __init__(
         self,
@@ -99,23 +101,42 @@ try breaking down the task into smaller steps. After call this tool to update or
         try:
             while True:
                 try:
-                    message: RealtimeEvent = await self.message_queue.get()
+                    # Take everything queued since the last pass, so a burst of events
+                    # (e.g. streamed output) goes out in one frame instead of one each
+                    batch: List[RealtimeEvent] = [await self.message_queue.get()]
+                    while (
+                        len(batch) < self.MAX_EVENTS_PER_FRAME
+                        and not self.message_queue.empty()
+                    ):
+                        batch.append(self.message_queue.get_nowait())
 
-                    # Save all events to database if we have a session
-                    if self.session_id is not None:
-                        self.db_manager.save_event(self.session_id, message)
-                    else:
-                        self.logger_for_agent_logs.info(
-                            f"No session ID, skipping event: {message}"
-                        )
+                    outgoing = []
+                    for message in batch:
+                        # Save all events to database if we have a session
+                        try:
+                            if self.session_id is not None:
+                                self.db_manager.save_event(self.session_id, message)
+                            else:
+                                self.logger_for_agent_logs.info(
+                                    f"No session ID, skipping event: {message}"
+                                )
+                        except Exception as e:
+                            # As before batching: an event that fails here is not sent
+                            self.logger_for_agent_logs.error(
+                                f"Error processing WebSocket message: {str(e)}"
+                            )
+                            continue
 
-                    # Only send to websocket if this is not an event from the client and websocket exists
-                    if (
-                        message.type != EventType.USER_MESSAGE
-                        and self.websocket is not None
-                    ):
+                        # Only send to websocket if this is not an event from the client
+                        if message.type != EventType.USER_MESSAGE:
+                            outgoing.append(message.model_dump())
+
+                    if outgoing and self.websocket is not None:
                         try:
-                            await self.websocket.send_json(message.model_dump())
+                            # A single event is sent as an object, several as an array of them
+                            await self.websocket.send_text(
+                                encode_frame(outgoing[0] if len(outgoing) == 1 else outgoing)
+                            )
                         except Exception as e:
                             # If websocket send fails, just log it and continue processing
                             self.logger_for_agent_logs.warning(
@@ -124,7 +145,8 @@ try breaking down the task into smaller steps. After call this tool to update or
                             # Set websocket to None to prevent further attempts
                             self.websocket = None
 
-                    self.message_queue.task_done()
+                    for _ in batch:
+                        self.message_queue.task_done()
                 except asyncio.CancelledError:
                     break
                 except Exception as e:
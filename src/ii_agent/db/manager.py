@@ -66,6 +66,13 @@ class DatabaseManager:
                     print("Running migration: Adding 'summary' column to 'session' table")
                     connection.execute(text("ALTER TABLE session ADD COLUMN summary VARCHAR"))
 
+                # create_all only adds indexes to newly created tables
+                if inspector.has_table("event"):
+                    connection.execute(text(
+                        "CREATE INDEX IF NOT EXISTS idx_event_session_type_ts "
+                        "ON event (session_id, event_type, timestamp)"
+                    ))
+
                 # Add other migrations here in the future
                 # Example for adding another column:
                 # if "new_column" not in columns:
@@ -1,6 +1,6 @@
 from datetime import datetime
 import uuid
-from sqlalchemy import Column, String, DateTime, ForeignKey, Integer
+from sqlalchemy import Column, String, DateTime, ForeignKey, Index, Integer
 from sqlalchemy.orm import relationship, declarative_base
 from sqlalchemy.dialects.sqlite import JSON as SQLiteJSON
 from typing import Optional
@@ -63,6 +63,11 @@ class Event(Base):
     # Relationship with session
     session = relationship("Session", back_populates="events")
 
+    __table_args__ = (
+        # Serves per-session event lookups filtered by type and ordered by time
+        Index("idx_event_session_type_ts", "session_id", "event_type", "timestamp"),
+    )
+
     def __init__(self, session_id: uuid.UUID, event_type: str, event_payload: dict):
         """Initialize an event.
 
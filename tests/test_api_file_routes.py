@@ -0,0 +1,100 @@
+import argparse
+import io
+import os
+import zipfile
+from urllib.parse import quote
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from server_components.api_file_routes import (
+    ZIP_PARALLEL_MAX_FILE_SIZE,
+    ZIP_PARALLEL_WINDOW,
+    StreamingZipFile,
+    deflate_file,
+    iter_zip_stream,
+    router,
+)
+from server_components.config import app_config
+
+
+def build_folder(root):
+    """Write a folder covering every entry path of iter_zip_stream; return {arcname: bytes}."""
+    files = {
+        "small.txt": b"hello zip\n" * 100,
+        "empty.txt": b"",
+        "nested/deeper/notes.md": b"# notes\n" + "ünïcödé ✓\n".encode("utf-8") * 50,
+        "ñandú/日本語ファイル.txt": "non-ASCII name".encode("utf-8"),
+        # Above ZIP_PARALLEL_MAX_FILE_SIZE: streamed through zipfile instead of the pool
+        "large.log": b"0123456789abcdef\n" * (ZIP_PARALLEL_MAX_FILE_SIZE // 17 + 1000),
+        # Incompressible extension: stored
+        "image.png": os.urandom(256 * 1024),
+        # Compressible extension, random content, within the pool size limit
+        "random.bin": os.urandom(512 * 1024),
+    }
+    # More pool-compressed entries than the window, so entries are written while others are queued
+    for i in range(ZIP_PARALLEL_WINDOW + 3):
+        files[f"many/file_{i}.txt"] = f"file {i}\n".encode("ascii") * (i + 1)
+
+    for arcname, data in files.items():
+        path = root.joinpath(*arcname.split("/"))
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    (root / ".hidden").write_bytes(b"skipped")
+    (root / ".git").mkdir()
+    (root / ".git" / "config").write_bytes(b"skipped")
+    return files
+
+
+def test_iter_zip_stream_round_trip(tmp_path):
+    files = build_folder(tmp_path)
+
+    archive = b"".join(iter_zip_stream(tmp_path))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        assert zipf.testzip() is None
+        assert sorted(zipf.namelist()) == sorted(files)
+        for arcname, data in files.items():
+            assert zipf.read(arcname) == data, arcname
+        assert zipf.getinfo("image.png").compress_type == zipfile.ZIP_STORED
+        assert zipf.getinfo("small.txt").compress_type == zipfile.ZIP_DEFLATED
+        assert zipf.getinfo("large.log").compress_type == zipfile.ZIP_DEFLATED
+
+
+def test_iter_zip_stream_empty_folder(tmp_path):
+    archive = b"".join(iter_zip_stream(tmp_path))
+
+    with zipfile.ZipFile(io.BytesIO(archive)) as zipf:
+        assert zipf.namelist() == []
+
+
+def test_download_zip_non_ascii_folder_name(tmp_path, monkeypatch):
+    folder_name = "Отчёт 日本語"
+    folder = tmp_path / "session" / folder_name
+    folder.mkdir(parents=True)
+    (folder / "a.txt").write_bytes(b"content")
+    monkeypatch.setattr(app_config, "args", argparse.Namespace(workspace=str(tmp_path)))
+    monkeypatch.setattr(app_config, "workspace_root", None)
+    app = FastAPI()
+    app.include_router(router)
+
+    response = TestClient(app).post(
+        "/api/files/download-zip", json={"workspace_id": "session", "path": folder_name}
+    )
+
+    assert response.status_code == 200
+    assert response.headers["content-disposition"] == f"attachment; filename*=utf-8''{quote(folder_name + '.zip')}"
+    with zipfile.ZipFile(io.BytesIO(response.content)) as zipf:
+        assert zipf.read("a.txt") == b"content"
+
+
+def test_write_precompressed_rejects_open_write_handle(tmp_path):
+    source = tmp_path / "data.txt"
+    source.write_bytes(b"data" * 10)
+    compressed, crc, size = deflate_file(str(source))
+
+    with StreamingZipFile(io.BytesIO(), "w") as zipf:
+        with zipf.open("other.txt", "w"):
+            with pytest.raises(ValueError):
+                zipf.write_precompressed(zipfile.ZipInfo("data.txt"), compressed, crc, size)
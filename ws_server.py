@@ -40,10 +40,12 @@ logging.basicConfig(level=logging.INFO) # Configure basic logging for startup me
 logger = logging.getLogger(__name__) # Logger for ws_server.py itself
 
 # Initialize FastAPI application
-app = FastAPI(title="Agent WebSocket and API Server")
+# Startup/shutdown (cleanup task, shared HTTP client) is handled by server_setup.lifespan
+app = FastAPI(title="Agent WebSocket and API Server", lifespan=server_setup.lifespan)
 
 # Add CORS middleware - this is a global middleware
-# Specific CORS headers for responses are handled by create_cors_response in common.py
+# It answers all preflight requests and adds the CORS headers to every response,
+# so handlers don't attach them themselves.
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],  # Allows all origins
@@ -51,11 +53,10 @@ app.add_middleware(
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS", "HEAD", "PATCH"], # Allow all common methods
     allow_headers=["*"],  # Allows all headers
     expose_headers=["*"], # Expose all headers to the client (e.g., for custom headers)
-    # max_age=86400 # Optional: How long the results of a preflight request can be cached
+    max_age=86400, # Let browsers cache preflight results for 24 hours
 )
 
 # Include API routers from different modules
-# The OPTIONS handler is now in api_general_routes.py, covering all paths.
 app.include_router(api_general_routes.router)
 app.include_router(api_session_routes.router)
 app.include_router(api_file_routes.router)
@@ -70,7 +71,6 @@ logger.info("WebSocket endpoint /ws registered.")
 # The main server startup logic, including argument parsing and Uvicorn run,
 # is now handled by server_setup.main_server_start.
 # The FastAPI app instance `app` is passed to it.
-# Startup and shutdown events (for periodic cleanup) are also registered within main_server_start.
 
 if __name__ == "__main__":
     logger.info("Starting server via __main__ block...")